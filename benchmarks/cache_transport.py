@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""Compares sending cache distribution tasks one by one with sending
+them through the batching transport.
+
+Usage: python benchmarks/cache_transport.py [tasks] [put latency, sec]
+
+Put latency emulates the cost of a single transport call."""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'cocaine-app'))
+
+from cache_transport.batching import BatchingTransport
+from cache_transport import fake_transport
+
+
+class SlowTransport(fake_transport.Transport):
+
+    def __init__(self, latency):
+        super(SlowTransport, self).__init__()
+        self.latency = latency
+        self.calls = 0
+
+    def put(self, task):
+        self.calls += 1
+        time.sleep(self.latency)
+        super(SlowTransport, self).put(task)
+
+    def put_many(self, data):
+        self.calls += 1
+        time.sleep(self.latency)
+        super(SlowTransport, self).put_many(data)
+
+
+def make_tasks(num):
+    return [{'key': 'key_%d' % i,
+             'dgroups': [1, 2, 3],
+             'sgroups': [10, 11],
+             'action': 'add'} for i in xrange(num)]
+
+
+def bench_single(tasks, latency):
+    t = SlowTransport(latency)
+    start = time.time()
+    for task in tasks:
+        t.put(json.dumps(task))
+    return time.time() - start, t
+
+
+def bench_batching(tasks, latency):
+    t = SlowTransport(latency)
+    bt = BatchingTransport(t)
+    start = time.time()
+    for task in tasks:
+        bt.put(task)
+    bt.flush()
+    return time.time() - start, t
+
+
+def main():
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0001
+    tasks = make_tasks(num)
+
+    for name, bench in (('single', bench_single), ('batching', bench_batching)):
+        elapsed, t = bench(tasks, latency)
+        assert len(t.tasks) == num
+        print '%-10s %d tasks, %d transport calls: %.3f sec, %.2f usec per task' % (
+            name, num, t.calls, elapsed, elapsed / num * 1000000)
+
+
+if __name__ == '__main__':
+    main()
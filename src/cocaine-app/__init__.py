@@ -3,10 +3,12 @@
 from functools import wraps, partial
 import logging
 import sys
-from time import sleep
+import threading
+import time
 import traceback
 import types
 
+from cocaine.exceptions import ChokeEvent
 from cocaine.worker import Worker
 
 sys.path.append('/usr/lib')
@@ -38,43 +40,67 @@ logger.info("trace %d" % (i.next()))
 log = elliptics.Logger(str(config["dnet_log"]), config["dnet_log_mask"])
 n = elliptics.Node(log)
 
-connected = False
+
+def add_remotes(node, hosts, quorum, deadline):
+    """Adds remote hosts to the node concurrently.
+
+    Returns as soon as quorum of hosts is connected, all the attempts
+    are finished or deadline is reached. Remaining attempts are left
+    to complete in background."""
+    cond = threading.Condition()
+    state = {'connected': 0, 'finished': 0}
+
+    def add_remote(host):
+        try:
+            logger.info("host: " + str(host))
+            node.add_remote(str(host[0]), host[1])
+            logger.info("Connected to %s" % str(host))
+            connected = True
+        except Exception as e:
+            logger.error("Failed to connect to %s: %s" % (str(host), e))
+            connected = False
+        with cond:
+            state['finished'] += 1
+            if connected:
+                state['connected'] += 1
+            cond.notify()
+
+    for host in hosts:
+        t = threading.Thread(target=add_remote, args=(host,))
+        t.daemon = True
+        t.start()
+
+    quorum = min(quorum, len(hosts))
+    deadline_ts = time.time() + deadline
+    with cond:
+        while state['connected'] < quorum and state['finished'] < len(hosts):
+            timeout = deadline_ts - time.time()
+            if timeout <= 0:
+                break
+            cond.wait(timeout)
+        if state['connected'] < quorum:
+            logger.warn('Connected to %d of %d hosts, quorum of %d '
+                        'is not reached' % (state['connected'], len(hosts), quorum))
+        return state['connected']
+
+
+connect_deadline = config.get('connect_deadline', 10)
 
 logger.info("trace %d" % (i.next()))
-for host in config["elliptics_nodes"]:
-    logger.debug("Adding node %s" % str(host))
-    try:
-        logger.info("host: " + str(host))
-        n.add_remote(str(host[0]), host[1])
-        connected = True
-    except Exception as e:
-        logger.error("Error: " + str(e) + "\n" + traceback.format_exc())
-
-if not connected:
+if not add_remotes(n, config["elliptics_nodes"],
+                   config.get('connect_quorum', 1), connect_deadline):
     logger.error('Failed to connect to any elliptics storage node')
     raise ValueError('Failed to connect to any elliptics storage node')
 
-connected = False
-
 logger.info("trace %d" % (i.next()))
 meta_node = elliptics.Node(log)
-for host in config["metadata"]["nodes"]:
-    try:
-        logger.info("host: " + str(host))
-        meta_node.add_remote(str(host[0]), host[1])
-        connected = True
-    except Exception as e:
-        logger.error("Error: " + str(e) + "\n" + traceback.format_exc())
-
-if not connected:
+if not add_remotes(meta_node, config["metadata"]["nodes"],
+                   config["metadata"].get('connect_quorum', 1), connect_deadline):
     logger.error('Failed to connect to any elliptics meta storage node')
     raise ValueError('Failed to connect to any elliptics storage node')
 
 
 wait_timeout = config.get('wait_timeout', 5)
-logger.info('sleeping for wait_timeout for nodes '
-             'to collect data ({0} sec)'.format(wait_timeout))
-sleep(wait_timeout)
 
 meta_session = elliptics.Session(meta_node)
 meta_session.set_timeout(wait_timeout)
@@ -94,15 +120,56 @@ logger.info("after creating worker")
 b = balancer.Balancer(n)
 
 
-def register_handle(h):
+class NotReadyError(Exception):
+    pass
+
+
+class Readiness(object):
+    """Initialization state of a subsystem"""
+
+    def __init__(self, name, event=None):
+        self.name = name
+        self.event = event or threading.Event()
+        self.error = None
+
+    def check(self):
+        if self.error:
+            raise NotReadyError('%s initialization failed: %s' % (self.name, self.error))
+        if not self.event.is_set():
+            raise NotReadyError('%s is warming up' % self.name)
+
+    def run(self, func, *args, **kwargs):
+        """Runs initialization function in a separate thread"""
+
+        def init():
+            logger.info("Initializing %s" % self.name)
+            try:
+                func(*args, **kwargs)
+                self.event.set()
+                logger.info("Initialized %s" % self.name)
+            except Exception as e:
+                logger.error("Failed to initialize %s: %s" % (self.name, traceback.format_exc().replace('\n', '    ')))
+                self.error = str(e)
+
+        t = threading.Thread(target=init, name='init_' + self.name)
+        t.daemon = True
+        t.start()
+
+
+def register_handle(h, requires=()):
     @wraps(h)
     def wrapper(request, response):
         try:
             data = yield request.read()
             data = msgpack.unpackb(data)
+            for r in requires:
+                r.check()
             logger.info("Running handler for event %s, data=%s" % (h.__name__, str(data)))
             #msgpack.pack(h(data), response)
             response.write(h(data))
+        except NotReadyError as e:
+            logger.info("Handler for event %s is not ready: %s" % (h.__name__, e))
+            response.write({"Balancer error": str(e)})
         except Exception as e:
             logger.error("Balancer error: %s" % traceback.format_exc().replace('\n', '    '))
             response.write({"Balancer error": str(e)})
@@ -113,40 +180,97 @@ def register_handle(h):
     return wrapper
 
 
-def init_infrastructure():
+def register_stream_handle(h, requires=()):
+    """Registers handler of a request streamed in msgpack chunks.
+
+    Handler is called with the first chunk and returns an object
+    consuming every following chunk by 'add' method,
+    its 'finish' method result is the response."""
+    @wraps(h)
+    def wrapper(request, response):
+        try:
+            data = yield request.read()
+            data = msgpack.unpackb(data)
+            for r in requires:
+                r.check()
+            logger.info("Running stream handler for event %s, data=%s" % (h.__name__, str(data)))
+            stream = h(data)
+            while True:
+                try:
+                    data = yield request.read()
+                except ChokeEvent:
+                    break
+                stream.add(msgpack.unpackb(data))
+            response.write(stream.finish())
+        except NotReadyError as e:
+            logger.info("Handler for event %s is not ready: %s" % (h.__name__, e))
+            response.write({"Balancer error": str(e)})
+        except Exception as e:
+            logger.error("Balancer error: %s" % traceback.format_exc().replace('\n', '    '))
+            response.write({"Balancer error": str(e)})
+        response.close()
+
+    W.on(h.__name__, wrapper)
+    logger.info("Registering stream handler for event %s" % h.__name__)
+    return wrapper
+
+
+infrastructure_ready = Readiness('infrastructure')
+
+
+def init_infrastructure(storage_ready):
     infstruct = infrastructure.infrastructure
-    infstruct.init(n)
-    register_handle(infstruct.restore_group_cmd)
-    b.set_infrastructure(infstruct)
+    register_handle(infstruct.restore_group_cmd, requires=(infrastructure_ready,))
+
+    def init():
+        infstruct.init(n)
+        b.set_infrastructure(infstruct)
+
+    infrastructure_ready.run(init)
+
+    def prefetch():
+        # hosts are known only after storage state is loaded
+        storage_ready.event.wait()
+        infrastructure_ready.event.wait()
+        infstruct.prefetch_host_caches()
+
+    Readiness('host caches').run(prefetch)
 
 
 def init_node_info_updater():
     logger.info("trace node info updater %d" % (i.next()))
-    niu = node_info_updater.NodeInfoUpdater(logging.getLogger('mm.nodes'), n)
+    niu = node_info_updater.NodeInfoUpdater(logging.getLogger('mm.nodes'), n, b)
     register_handle(niu.force_nodes_update)
 
     return niu
 
 
-def init_cache():
+def init_cache(storage_ready):
     manager = cache.CacheManager()
-    if 'cache' in config:
-        manager.setup(n.meta_session, config['cache'].get('index_prefix', 'cached_files_'))
-        [manager.add_namespace(ns) for ns in config['cache'].get('namespaces', [])]
+    cache_ready = Readiness('cache')
+
+    def init():
+        storage_ready.event.wait()
+        if 'cache' in config:
+            manager.setup(n.meta_session, config['cache'].get('index_prefix', 'cached_files_'))
+            [manager.add_namespace(ns) for ns in config['cache'].get('namespaces', [])]
+
+    cache_ready.run(init)
 
     # registering cache handlers
-    register_handle(manager.get_cached_keys)
-    register_handle(manager.get_cached_keys_by_group)
-    register_handle(manager.upload_list)
+    register_handle(manager.get_cached_keys, requires=(cache_ready,))
+    register_handle(manager.get_cached_keys_by_group, requires=(cache_ready,))
+    register_handle(manager.upload_list, requires=(cache_ready,))
+    register_stream_handle(manager.upload_list_stream, requires=(cache_ready,))
 
     return manager
 
 
-def init_statistics():
+def init_statistics(requires):
     stat = statistics.Statistics(b)
-    register_handle(stat.get_flow_stats)
-    register_handle(stat.get_groups_tree)
-    register_handle(stat.get_couple_statistics)
+    register_handle(stat.get_flow_stats, requires=requires)
+    register_handle(stat.get_groups_tree, requires=requires)
+    register_handle(stat.get_couple_statistics, requires=requires)
     return stat
 
 
@@ -159,15 +283,22 @@ def init_minions():
     return m
 
 
-init_cache()
-init_infrastructure()
-init_node_info_updater()
-init_statistics()
+# subsystems are initialized in background, their handlers
+# answer with "warming up" error until the data is ready
+niu = init_node_info_updater()
+storage_ready = Readiness('storage', niu.ready)
+init_infrastructure(storage_ready)
+init_cache(storage_ready)
+init_statistics((storage_ready, infrastructure_ready))
 init_minions()
 
 for handler in balancer.handlers(b):
     logger.info("registering bounded function %s" % handler)
-    register_handle(handler)
+    if handler.__name__ in balancer.INFRASTRUCTURE_HANDLERS:
+        requires = (storage_ready, infrastructure_ready)
+    else:
+        requires = (storage_ready,)
+    register_handle(handler, requires=requires)
 
 logger.info("Starting worker")
 W.run()
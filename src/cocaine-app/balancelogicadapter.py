@@ -3,6 +3,8 @@ from time import time
 import copy
 import threading
 
+import balancelogic
+
 import inventory
 import storage
 
@@ -58,9 +60,45 @@ def _and(*lambdas):
     return combined
 
 
+def _any(symm_group):
+    return True
+
+
+def partition(symm_groups):
+    """Splits symm groups into buckets by (namespace, size)"""
+    buckets = {}
+    for symm_group in symm_groups:
+        key = (symm_group.namespace, len(symm_group.unitId()))
+        buckets.setdefault(key, []).append(symm_group)
+    return buckets
+
+
+def rawBalancePartitioned(symm_groups, config):
+    """Balances every (namespace, size) bucket of symm groups independently.
+    Yields (namespace, size, group_weights, info) for every bucket"""
+    for (namespace, size), bucket in partition(symm_groups).iteritems():
+        group_weights, info = balancelogic.rawBalance(bucket, config, _any)
+        yield namespace, size, group_weights, info
+
+
+class BalancingSnapshot(object):
+    """Balancer config and couple stats frozen for a single balancing pass"""
+
+    def __init__(self, couples):
+        self.config = getConfig()
+        self.too_old_age = self.config.get("dynamic_too_old_age", 120)
+        self.symm_groups = []
+        self.stats = {}
+        for couple in couples:
+            symm_group = SymmGroup(couple, snapshot=self)
+            self.symm_groups.append(symm_group)
+            self.stats[couple] = symm_group.stat
+
+
 class SymmGroup:
-    def __init__(self, couple):
+    def __init__(self, couple, snapshot=None):
         self.couple = couple
+        self.snapshot = snapshot
         self.stat = self.couple.get_stat()
         self.status = self.couple.status
 
@@ -101,7 +139,8 @@ class SymmGroup:
         return self.status in storage.GOOD_STATUSES
 
     def isBad(self):
-        too_old_age = getConfig().get("dynamic_too_old_age", 120)
+        too_old_age = (self.snapshot.too_old_age if self.snapshot else
+                       getConfig().get("dynamic_too_old_age", 120))
         return self.status not in storage.GOOD_STATUSES or self.stat.ts < (time() - too_old_age)
 
     def dataType(self):
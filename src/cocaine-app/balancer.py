@@ -1,9 +1,12 @@
 # encoding: utf-8
 import copy
 from datetime import datetime
+import hashlib
+import json
 import logging
 import re
 import sys
+import threading
 import time
 import traceback
 
@@ -12,7 +15,6 @@ import elliptics
 import msgpack
 
 import balancelogicadapter as bla
-import balancelogic
 from compat import EllAsyncResult, EllReadResult, EllLookupResult
 from config import config
 import helpers as h
@@ -39,6 +41,12 @@ class Balancer(object):
                                    keys.MM_NAMESPACE_SETTINGS_KEY_TPL,
                                    self.node.meta_session)
 
+        # (generation, weights) of the latest group weights calculation,
+        # generation is a digest of weights, so it is the same for
+        # equal weights regardless of the worker that calculated them
+        self.__weights = None
+        self.__weights_lock = threading.Lock()
+
     def set_infrastructure(self, infrastructure):
         self.infrastructure = infrastructure
 
@@ -47,19 +55,21 @@ class Balancer(object):
 
     @h.handler
     def get_symmetric_groups(self, request):
-        result = [couple.as_tuple() for couple in storage.couples if couple.status == storage.Status.OK]
+        result = [couple.as_tuple() for couple in storage.couples.find('status', storage.Status.OK)]
         logger.debug('good_symm_groups: ' + str(result))
         return result
 
     @h.handler
     def get_bad_groups(self, request):
-        result = [couple.as_tuple() for couple in storage.couples if couple.status not in storage.NOT_BAD_STATUSES]
+        bad_statuses = [status for status in storage.couples.index_keys('status')
+                        if status not in storage.NOT_BAD_STATUSES]
+        result = [couple.as_tuple() for couple in storage.couples.find('status', *bad_statuses)]
         logger.debug('bad_symm_groups: ' + str(result))
         return result
 
     @h.handler
     def get_frozen_groups(self, request):
-        result = [couple.as_tuple() for couple in storage.couples if couple.status == storage.Status.FROZEN]
+        result = [couple.as_tuple() for couple in storage.couples.find('status', storage.Status.FROZEN)]
         logger.debug('frozen_couples: ' + str(result))
         return result
 
@@ -72,8 +82,7 @@ class Balancer(object):
         logger.debug('configured min_free_space: %s bytes' % min_free_space)
         logger.debug('configured min_rel_space: %s' % min_rel_space)
 
-        result = [couple.as_tuple() for couple in storage.couples
-                  if couple.status == storage.Status.FULL]
+        result = [couple.as_tuple() for couple in storage.couples.find('status', storage.Status.FULL)]
 
         logger.debug('closed couples: ' + str(result))
         return result
@@ -81,8 +90,7 @@ class Balancer(object):
     @h.handler
     def get_empty_groups(self, request):
         logger.info('len(storage.groups) = %d' % (len(storage.groups.elements)))
-        logger.info('groups: %s' % str([(group.group_id, group.couple) for group in storage.groups if group.couple is None]))
-        result = [group.group_id for group in storage.groups if group.couple is None]
+        result = [group.group_id for group in storage.groups.find('uncoupled', True)]
         logger.debug('uncoupled groups: ' + str(result))
         return result
 
@@ -98,15 +106,16 @@ class Balancer(object):
     def get_couples_list(self, request):
         options = request[0]
 
-        couples = storage.couples.keys()
-
-        if options.get('namespace', None):
-            couples = filter(lambda c: c.namespace == options['namespace'], couples)
-
         if options.get('state', None):
             if options['state'] not in self.STATES:
                 raise ValueError('Invalid state: {0}'.format(options['state']))
-            couples = filter(lambda c: c.status in self.STATES[options['state']], couples)
+            couples = storage.couples.find('status', *self.STATES[options['state']])
+        else:
+            couples = storage.couples.keys()
+
+        if options.get('namespace', None):
+            ns_couples = set(storage.couples.find('namespace', options['namespace']))
+            couples = [c for c in couples if c in ns_couples]
 
         data = []
         for c in couples:
@@ -199,32 +208,64 @@ class Balancer(object):
 
     @h.handler
     def get_group_weights(self, request):
-        namespaces = {}
-        all_symm_group_objects = []
-        for couple in storage.couples:
-            if couple.status not in storage.GOOD_STATUSES:
-                continue
+        return self.__group_weights()[1]
+
+    @h.handler
+    def get_group_weights_snapshot(self, request):
+        """Returns group weights along with their generation.
+        If request contains the current generation,
+        weights are not sent back."""
+        generation, weights = self.__group_weights()
+
+        if request and request[0] == generation:
+            return {'generation': generation,
+                    'not_modified': True}
+
+        return {'generation': generation,
+                'weights': weights}
+
+    def update_group_weights(self):
+        """Recalculates group weights snapshot, should be called
+        after storage state is updated"""
+        weights = self.__calculate_group_weights()
+        generation = hashlib.md5(json.dumps(weights, sort_keys=True)).hexdigest()
+        with self.__weights_lock:
+            self.__weights = (generation, weights)
+        logger.info('Group weights updated, generation %s' % generation)
+        return generation
+
+    def __refresh_group_weights(self):
+        """Updates group weights after a storage change has been applied,
+        failure is not reported to the client as the change is done,
+        weights are recalculated with the next storage state update"""
+        try:
+            self.update_group_weights()
+        except Exception as e:
+            logger.error('Failed to update group weights: %s\n%s' %
+                         (e, traceback.format_exc()))
+
+    def __group_weights(self):
+        if self.__weights is None:
+            self.update_group_weights()
+        weights = self.__weights
+        if weights is None:
+            raise ValueError('Group weights are not calculated yet')
+        return weights
 
-            symm_group = bla.SymmGroup(couple)
-            namespaces.setdefault(couple.namespace, set())
-            namespaces[couple.namespace].add(len(couple))
-            all_symm_group_objects.append(symm_group)
-            # logger.debug(str(symm_group))
+    def __calculate_group_weights(self):
+        snapshot = bla.BalancingSnapshot(
+            storage.couples.find('status', *storage.GOOD_STATUSES))
 
         result = {}
 
-        for namespace, sizes in namespaces.iteritems():
-            for size in sizes:
-                (group_weights, info) = balancelogic.rawBalance(all_symm_group_objects,
-                                                                bla.getConfig(),
-                                                                bla._and(bla.GroupSizeEquals(size),
-                                                                         bla.GroupNamespaceEquals(namespace)))
-                result.setdefault(namespace, {})[size] = \
-                    [([g.group_id for g in item[0].groups],) +
-                         item[1:] +
-                         (int(item[0].get_stat().free_space),)
-                     for item in group_weights.items()]
-                logger.info('Cluster info: ' + str(info))
+        for namespace, size, group_weights, info in bla.rawBalancePartitioned(
+                snapshot.symm_groups, snapshot.config):
+            result.setdefault(namespace, {})[size] = \
+                [([g.group_id for g in item[0].groups],) +
+                     item[1:] +
+                     (int(snapshot.stats[item[0]].free_space),)
+                 for item in group_weights.items()]
+            logger.info('Cluster info: ' + str(info))
 
         logger.info(str(result))
         return result
@@ -302,10 +343,13 @@ class Balancer(object):
     @h.handler
     def get_group_history(self, request):
         group = int(request[0])
+        page = int(request[1]) if len(request) > 1 else None
         group_history = {}
 
         if self.infrastructure:
-            for key, data in self.infrastructure.get_group_history(group).iteritems():
+            history = self.infrastructure.get_group_history(group, page)
+            group_history['pages'] = history.pop('pages')
+            for key, data in history.iteritems():
                 for nodes_data in data:
                     dt = datetime.fromtimestamp(nodes_data['timestamp'])
                     nodes_data['timestamp'] = dt.strftime(self.DT_FORMAT)
@@ -442,6 +486,8 @@ class Balancer(object):
         if bad:
             raise bad[1]
 
+        self.__refresh_group_weights()
+
         return groups_to_couple
 
     @h.handler
@@ -477,6 +523,8 @@ class Balancer(object):
         kill_symm_group(self.node, self.node.meta_session, couple)
         couple.destroy()
 
+        self.__refresh_group_weights()
+
         return True
 
     @h.handler
@@ -529,6 +577,7 @@ class Balancer(object):
                        EllLookupResult).get()
 
         couple.update_status()
+        self.__refresh_group_weights()
 
     ALPHANUM = 'a-zA-Z0-9'
     EXTRA = '\-_'
@@ -579,8 +628,8 @@ class Balancer(object):
                 raise ValueError('Couple {0} namespace is {1}, not {2}'.format(ref_couple,
                     ref_couple.namespace, namespace))
 
-            for c in storage.couples:
-                if c.namespace == namespace and c != ref_couple:
+            for c in storage.couples.find('namespace', namespace):
+                if c != ref_couple:
                     raise ValueError('Namespace "{0}" has several couples, '
                         'should have only 1 couple for static couple setting'.format(namespace))
 
@@ -700,8 +749,20 @@ class Balancer(object):
         return tuple(self.__all_namespaces())
 
     def __all_namespaces(self):
-        namespaces = [c.namespace for c in storage.couples]
-        return set(filter(None, namespaces))
+        return set(filter(None, storage.couples.index_keys('namespace')))
+
+
+# handlers using host names and dcs resolved by infrastructure
+INFRASTRUCTURE_HANDLERS = set([
+    'couple_groups',
+    'couples_by_namespace',
+    'get_couple_info',
+    'get_couples_list',
+    'get_group_history',
+    'get_group_info',
+    'group_detach_node',
+    'groups_by_dc',
+])
 
 
 def handlers(b):
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import copy
 from functools import wraps
+import heapq
 from itertools import imap
 import json
 import logging
@@ -49,14 +50,20 @@ class CacheManager(object):
         self.__bw_degradation_threshold = 5
 
         self.keys = {}
+        # namespace keys ordered by traffic
+        self.traffic_index = {}
+        # (namespace, key) pairs cached by group id
+        self.group_keys = {}
         self.instances = {}
+        # cache instance weights, refreshed on cache status update
+        self.weights = {}
 
     def setup(self, session, index_prefix):
         self.__session = session
         self.__index_prefix = index_prefix
 
-        self.__tq = timed_queue.TimedQueue()
-        self.__tq.start()
+        self.__tq = timed_queue.shared_queue().register('cache',
+                                                        exclusive=True)
 
         self.__tq.add_task_in('cache_status_update', 10, self.cache_status_update)
         self.__tq.add_task_in('cache_list_update', 15, self.update_cache_list)
@@ -113,9 +120,39 @@ class CacheManager(object):
 
         return 'processed'
 
-    def __sync(self, items, namespace=None, passive=True):
+    def upload_list_stream(self, request):
+        """Starts cache list uploading in chunks.
+
+        Request contains the namespace, returned upload object
+        consumes lists of files and should be finished when
+        all of them are consumed."""
+
+        if not self.enabled:
+            raise RuntimeError('Cache list uploading is not available: '
+                               'cache is not set up')
+
+        ns = request['namespace']
+        if not ns in self.__namespaces:
+            raise ValueError('Invalid cache namespace: %s' % ns)
+
+        logger.info('Starting cache list upload for namespace %s' % ns)
+        return CacheListUpload(self, ns)
+
+    @update_lock
+    def _upload_chunk(self, namespace, files):
+        files = sorted(files, key=lambda f: f['traffic'], reverse=True)
+        self.__sync(files, namespace=namespace, passive=False, remove_missing=False)
+
+    @update_lock
+    def _upload_finish(self, namespace, uploaded_keys):
+        keys_to_remove = {namespace: set(self.keys[namespace]) - uploaded_keys}
+        self.__sync_removed(keys_to_remove, [namespace], passive=False)
+        self.__flush_transport()
+
+    def __sync(self, items, namespace=None, passive=True, remove_missing=True):
         """Keeps the internal state up with remote meta state.
-        Updates current state along with remote meta state when passive=False"""
+        Updates current state along with remote meta state when passive=False.
+        Keys missing in items are removed unless remove_missing=False"""
         keys_to_remove = {}
 
         if namespace and namespace in self.__namespaces:
@@ -166,6 +203,7 @@ class CacheManager(object):
                 updated_key = self.keys[ns].setdefault(key['key'], {'dgroups': []})
                 updated_key.update(key)
                 updated_key['namespace'] = ns
+                self.traffic_index[ns].update(updated_key)
 
                 if req_ci_num == 0:
                     ext_groups = cur_groups
@@ -177,7 +215,7 @@ class CacheManager(object):
                     updated_key['dgroups'] = list(ext_groups)
 
                     task = self.__transport_key(updated_key, action='remove', dgroups=list(gids))
-                    transport.put(json.dumps(task))
+                    transport.put(task)
                 else:
                     space_needed = self.__need_space(ns, req_ci_num, item[self.ITEM_SIZE_KEY])
                     if space_needed > 0:
@@ -197,7 +235,7 @@ class CacheManager(object):
                     # TODO: exclude existing dgroups from task
                     task = self.__transport_key(updated_key, action='add')
                     logger.info('Put task for cache distribution: %s' % task)
-                    transport.put(json.dumps(task))
+                    transport.put(task)
 
                 self.__upstream_update_key(ns, updated_key)
 
@@ -206,22 +244,36 @@ class CacheManager(object):
                 # dgroups should contain only groups that are in our cache instances
                 updated_key['dgroups'] = list(ext_groups)
                 self.keys[ns][item['key']] = updated_key
+                self.traffic_index[ns].update(updated_key)
                 logger.info('External key %s' % (updated_key,))
 
             for gid in cur_groups - ext_groups:
+                self.__unindex_group_key(gid, ns, item['key'])
                 group = storage.groups[gid]
                 self.instances[group].remove_file(item[self.ITEM_SIZE_KEY])
                 self.__namespaces[ns]['cache_size'] -= item[self.ITEM_SIZE_KEY]
                 logger.info('Namespace %s: cache size changed -%s = %s' %
                              (ns, mb(item[self.ITEM_SIZE_KEY]), mb(self.__namespaces[ns]['cache_size'])))
             for gid in ext_groups - cur_groups:
+                self.group_keys.setdefault(gid, set()).add((ns, item['key']))
                 group = storage.groups[gid]
                 self.instances[group].add_file(item[self.ITEM_SIZE_KEY])
                 self.__namespaces[ns]['cache_size'] += item[self.ITEM_SIZE_KEY]
                 logger.info('Namespace %s: cache size changed +%s = %s' %
                              (ns, mb(item[self.ITEM_SIZE_KEY]), mb(self.__namespaces[ns]['cache_size'])))
 
-        self.__sync_removed(keys_to_remove, namespaces, passive=passive)
+        if remove_missing:
+            self.__sync_removed(keys_to_remove, namespaces, passive=passive)
+
+        if not passive:
+            self.__flush_transport()
+
+    def __flush_transport(self):
+        try:
+            transport.flush()
+        except Exception as e:
+            # state is already updated, transport resends the tasks
+            logger.error('Failed to flush cache distribution tasks: %s' % e)
 
     def __sync_removed(self, keys_to_remove, namespaces, passive=True):
         for ns in namespaces:
@@ -231,16 +283,18 @@ class CacheManager(object):
                 if not passive:
                     task = self.__transport_key(existing_key, action='remove', dgroups=existing_key['dgroups'])
                     logger.info('Put task for cache distribution: %s' % task)
-                    transport.put(json.dumps(task))
+                    transport.put(task)
                     self.__upstream_remove_key(ns, existing_key)
 
                 for gid in existing_key['dgroups']:
+                    self.__unindex_group_key(gid, ns, key)
                     self.instances[gid].remove_file(existing_key[self.ITEM_SIZE_KEY])
                     self.__namespaces[ns]['cache_size'] -= existing_key[self.ITEM_SIZE_KEY]
                     logger.info('Namespace %s: cache size changed -%s = %s' %
                                  (ns, mb(existing_key[self.ITEM_SIZE_KEY]), mb(self.__namespaces[ns]['cache_size'])))
 
                 del self.keys[ns][key]
+                self.traffic_index[ns].remove(key)
 
     def __upstream_update_key(self, namespace, key):
         key_ = key['key']
@@ -266,6 +320,14 @@ class CacheManager(object):
         logger.info('Updated indexes for key %s: %s %s' % (key_, updated_indexes, updated_datas))
         self.__session.set_indexes(eid, updated_indexes, updated_datas)
 
+    def __unindex_group_key(self, gid, namespace, key):
+        group_keys = self.group_keys.get(gid)
+        if group_keys is None:
+            return
+        group_keys.discard((namespace, key))
+        if not group_keys:
+            del self.group_keys[gid]
+
     def get_cached_keys(self, request):
         res = []
         for ns_keys in self.keys.itervalues():
@@ -286,16 +348,12 @@ class CacheManager(object):
         if not self.enabled:
             return res
 
-        indexes = [(self.__index_prefix + ns).encode('utf-8') for ns in self.__namespaces]
-        for item in self.__session.find_any_indexes(indexes):
-            try:
-                item = json.loads(item.indexes[0].data)
-            except Exception as e:
-                logger.info('Failed to load cache item: %s' % e)
+        keys = set()
+        for ns, key in self.group_keys.get(group_id, ()):
+            if key in keys:
                 continue
-
-            if group_id in item['dgroups']:
-                res.append(self.__transport_key(item))
+            keys.add(key)
+            res.append(self.__transport_key(self.keys[ns][key]))
 
         return res
 
@@ -314,21 +372,23 @@ class CacheManager(object):
         return (filesize * req_ci_num) - (ns_stat['total_space'] - ns_stat['cache_size'])
 
     def __pop_least_popular_keys(self, namespace, traffic, space_needed=0):
-        sorted_keys = sorted(self.keys[namespace].itervalues(),
-                             key=lambda k: k['traffic'], reverse=True)
-        l_key, sorted_keys = sorted_keys[-1], sorted_keys[:-1]
+        traffic_index = self.traffic_index[namespace]
 
         freed_space = 0
 
         keys_to_remove = {namespace: set()}
 
-        logger.info('Traffic checking %s > %s' % (traffic, l_key['traffic']))
-        while freed_space < space_needed and traffic > l_key['traffic']:
+        l_key = traffic_index.least_popular()
+        if l_key:
+            logger.info('Traffic checking %s > %s' % (traffic, l_key['traffic']))
+        while (l_key and freed_space < space_needed and
+               traffic > l_key['traffic']):
 
-            keys_to_remove[namespace].add(l_key['key'])
-
-            freed_space += len(l_key['dgroups']) * l_key[self.ITEM_SIZE_KEY]
-            l_key, sorted_keys = sorted_keys[-1], sorted_keys[:-1]
+            traffic_index.pop()
+            if l_key['key'] not in keys_to_remove[namespace]:
+                keys_to_remove[namespace].add(l_key['key'])
+                freed_space += len(l_key['dgroups']) * l_key[self.ITEM_SIZE_KEY]
+            l_key = traffic_index.least_popular()
 
         logger.info('Keys to be removed to free space: %s' % (keys_to_remove,))
         self.__sync_removed(keys_to_remove, [namespace], passive=False)
@@ -349,6 +409,7 @@ class CacheManager(object):
         self.__namespaces.setdefault(namespace, {'total_space': total_space,
                                                  'cache_size': 0.0})
         self.keys[namespace] = {}
+        self.traffic_index[namespace] = TrafficIndex(self.keys[namespace])
 
     def cache_status_update(self):
         try:
@@ -371,6 +432,9 @@ class CacheManager(object):
                                       if median <= self.__bw_degradation_threshold else
                                       self.__bandwidth_degrade(median) * self.__base_bw_per_instance)
             logger.info('Node bandwidth was set to %s Mbytes/sec' % self.__bw_per_instance)
+
+            self.weights = dict((ci, ci.weight) for ci in self.instances)
+            logger.info('Cache instances weights: %s' % self.weights)
         except Exception as e:
             logger.error("Error while updating cache bandwidth: %s\n%s" % (str(e), traceback.format_exc()))
         finally:
@@ -386,24 +450,15 @@ class CacheManager(object):
     def __cache_instances_num(self, traffic):
         return min(len(self.instances), int(traffic / self.__bw_per_instance) + 1)
 
+    def __weight(self, ci):
+        weight = self.weights.get(ci)
+        if weight is None:
+            weight = ci.weight
+        return weight
+
     def __cache_instances_rnd_choice(self, cis, num):
-        # bad algorithm: weights sum is calculated for every cache instance
-        # separately
-        choice = []
-        for i in xrange(num):
-            idx = 0
-            weights = [ci.weight for ci in cis]
-            weights_sum = sum(weights)
-            logger.info('Cache instances weights: %s' % weights)
-            rnd = random.random() * weights_sum
-            for i, w in enumerate(weights):
-                rnd -= w
-                if rnd < 0:
-                    idx = i
-                    break
-            choice.append(cis[idx])
-            del cis[idx]
-        return choice
+        sampler = WeightedSampler(cis, [self.__weight(ci) for ci in cis])
+        return sampler.sample(num)
 
     def __cis_choose_add(self, req_num, sgroups, traffic, filesize):
         cis = self.instances.keys()
@@ -451,13 +506,151 @@ class CacheManager(object):
 
     def __cis_choose_remove(self, req_num, dgroups):
         cis = [self.instances[storage.groups[g]] for g in dgroups]
-        return sorted(cis, key=lambda ci: ci.weight, reverse=True)[:req_num]
+        return sorted(cis, key=self.__weight, reverse=True)[:req_num]
 
 
 def mb(bytes):
     return '%.2f Mb' % (float(bytes) / (1024 * 1024))
 
 
+class CacheListUpload(object):
+    """Cache list uploaded in chunks.
+
+    Every chunk is processed under the update lock which is released
+    between chunks. Chunks are expected to be ordered by traffic,
+    namespace keys missing in all of the chunks are removed
+    on finish."""
+
+    def __init__(self, manager, namespace):
+        self.manager = manager
+        self.namespace = namespace
+        self.uploaded_keys = set()
+
+    def add(self, files):
+        logger.info('Uploading %d files to namespace %s' % (len(files), self.namespace))
+        self.manager._upload_chunk(self.namespace, files)
+        self.uploaded_keys.update(f['key'] for f in files)
+
+    def finish(self):
+        self.manager._upload_finish(self.namespace, self.uploaded_keys)
+        logger.info('Finished cache list upload for namespace %s: %d files' %
+                    (self.namespace, len(self.uploaded_keys)))
+        return {'processed': len(self.uploaded_keys)}
+
+
+class TrafficIndex(object):
+    """Min-heap of namespace keys ordered by traffic.
+
+    Only one entry per key is live (the one with the traffic value
+    recorded in self.entries), entries of removed keys and outdated
+    traffic values are skipped lazily, the heap is rebuilt when they prevail."""
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.heap = []
+        self.entries = {}
+
+    def update(self, key):
+        if self.entries.get(key['key']) == key['traffic']:
+            return
+        self.entries[key['key']] = key['traffic']
+        heapq.heappush(self.heap, (key['traffic'], key['key']))
+        if len(self.heap) > 2 * len(self.keys) + 64:
+            self.entries = dict((k['key'], k['traffic']) for k in self.keys.itervalues())
+            self.heap = [(traffic, key) for key, traffic in self.entries.iteritems()]
+            heapq.heapify(self.heap)
+
+    def least_popular(self):
+        """Returns the key with the least traffic or None"""
+        while self.heap:
+            traffic, key = self.heap[0]
+            item = self.keys.get(key)
+            if (item is not None and item['traffic'] == traffic and
+                    self.entries.get(key) == traffic):
+                return item
+            heapq.heappop(self.heap)
+            if item is None:
+                self.entries.pop(key, None)
+        return None
+
+    def pop(self):
+        item = self.least_popular()
+        if item is not None:
+            heapq.heappop(self.heap)
+            del self.entries[item['key']]
+        return item
+
+    def remove(self, key):
+        """Drops the key, its heap entry is skipped lazily"""
+        self.entries.pop(key, None)
+
+
+class WeightedSampler(object):
+    """Samples items without replacement with probabilities
+    proportional to their weights.
+
+    Weights are kept in a Fenwick tree, so every pick
+    takes O(log n). Negative weights are treated as zero, when
+    no weight is left the rest of items are taken in order."""
+
+    def __init__(self, items, weights):
+        self.items = list(items)
+        self.weights = [max(float(w), 0.0) for w in weights]
+        self.size = len(self.items)
+        self.total = sum(self.weights)
+
+        self.tree = [0.0] + self.weights
+        for i in xrange(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+
+        self.step = 1
+        while self.step * 2 <= self.size:
+            self.step *= 2
+
+    def __add(self, idx, delta):
+        i = idx + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def __find(self, value):
+        """Returns index of the first item with weights prefix sum exceeding value"""
+        pos = 0
+        step = self.step
+        while step:
+            i = pos + step
+            if i <= self.size and self.tree[i] <= value:
+                pos = i
+                value -= self.tree[i]
+            step /= 2
+        return pos
+
+    def sample(self, num):
+        num = min(num, self.size)
+        picked = []
+        while len(picked) < num:
+            if self.total <= 0:
+                self.total = sum(self.weights)
+                if self.total <= 0:
+                    break
+            idx = self.__find(random.random() * self.total)
+            if idx >= self.size or not self.weights[idx]:
+                # rounding error, last item with a weight is taken
+                idx = max(i for i in xrange(self.size) if self.weights[i])
+            picked.append(idx)
+            self.__add(idx, -self.weights[idx])
+            self.total -= self.weights[idx]
+            self.weights[idx] = 0.0
+
+        # weightless items are taken in order
+        chosen = set(picked)
+        picked.extend([idx for idx in xrange(self.size)
+                       if idx not in chosen][:num - len(picked)])
+        return [self.items[idx] for idx in picked]
+
+
 class CacheInstance(object):
 
     LA_THRESHOLD = 10.0
@@ -0,0 +1,87 @@
+# encoding: utf-8
+import json
+import logging
+import threading
+
+import msgpack
+
+
+logger = logging.getLogger('mm.cache')
+
+
+class BatchingTransport(object):
+    """Buffers cache distribution tasks and sends them in batches.
+
+    Batch is sent when it reaches max_size tasks or max_delay seconds
+    after its first task was put. Transports supporting put_many receive
+    the whole batch encoded with msgpack, other transports receive tasks
+    one by one encoded with json.
+
+    Tasks that failed to be sent are kept and resent by timer.
+    flush raises the send error, flushes by timer or by batch size
+    only log and count it."""
+
+    def __init__(self, transport, max_size=1000, max_delay=1.0):
+        self.transport = transport
+        self.max_size = max_size
+        self.max_delay = max_delay
+
+        self.__tasks = []
+        self.__timer = None
+        # number of failed flushes by timer or by batch size
+        self.errors = 0
+        self.__lock = threading.Lock()
+        # keeps batches in the order they were put
+        self.__send_lock = threading.Lock()
+
+    def put(self, task):
+        self.put_many([task])
+
+    def put_many(self, tasks):
+        with self.__lock:
+            self.__tasks.extend(tasks)
+            full = len(self.__tasks) >= self.max_size
+            if not full and self.__tasks:
+                self.__start_timer()
+        if full:
+            self.__flush_quietly()
+
+    def __start_timer(self):
+        if self.__timer is None:
+            self.__timer = threading.Timer(self.max_delay, self.__flush_quietly)
+            self.__timer.daemon = True
+            self.__timer.start()
+
+    def flush(self):
+        with self.__send_lock:
+            with self.__lock:
+                tasks, self.__tasks = self.__tasks, []
+                if self.__timer is not None:
+                    self.__timer.cancel()
+                    self.__timer = None
+
+            for i in xrange(0, len(tasks), self.max_size):
+                try:
+                    self.__send(tasks[i:i + self.max_size])
+                except Exception as e:
+                    logger.error('Failed to send %d cache distribution tasks: %s' %
+                                 (len(tasks) - i, e))
+                    with self.__lock:
+                        self.__tasks[:0] = tasks[i:]
+                        self.__start_timer()
+                    raise
+
+    def __flush_quietly(self):
+        try:
+            self.flush()
+        except Exception:
+            # tasks are resent by timer, error is already logged
+            self.errors += 1
+
+    def __send(self, batch):
+        logger.info('Sending %d cache distribution tasks' % len(batch))
+        if hasattr(self.transport, 'put_many'):
+            self.transport.put_many(msgpack.packb(batch))
+        else:
+            for task in batch:
+                self.transport.put(json.dumps(task))
@@ -1,3 +1,6 @@
+import json
+
+import msgpack
 
 
 class Transport(object):
@@ -6,4 +9,9 @@ class Transport(object):
         self.tasks = {}
 
     def put(self, task):
+        task = json.loads(task)
         self.tasks[task['key']] = task
+
+    def put_many(self, data):
+        for task in msgpack.unpackb(data):
+            self.tasks[task['key']] = task
@@ -2,6 +2,7 @@
 from copy import deepcopy
 import json
 
+from batching import BatchingTransport
 from importer import import_object
 
 
@@ -23,4 +24,7 @@ def encode_dict(params):
     return dict([(k, v if not isinstance(v, unicode) else v.encode('utf-8'))
                  for k, v in params.iteritems()])
 
-transport = Transport(**encode_dict(params))
+cache_config = config.get('cache', {})
+transport = BatchingTransport(Transport(**encode_dict(params)),
+                              max_size=cache_config.get('transport_batch_size', 1000),
+                              max_delay=cache_config.get('transport_batch_delay', 1.0))
@@ -1,5 +1,8 @@
+from collections import deque
+from functools import partial
 import keys
 import logging
+from multiprocessing.pool import ThreadPool
 import os.path
 import socket
 import threading
@@ -9,6 +12,7 @@ import traceback
 import elliptics
 import msgpack
 
+from compat import EllAsyncResult, EllLookupResult, EllReadResult
 import inventory
 from config import config
 import storage
@@ -31,6 +35,38 @@ logger.info('Rsync module using: %s' % RSYNC_MODULE)
 logger.info('Rsync user: %s' % RSYNC_USER)
 
 
+def write_many(writes, window, what):
+    """Issues writes keeping at most window of them in flight.
+
+    writes are (key, write function) pairs, returns keys
+    of successful writes."""
+    done = set()
+
+    def wait(key, result):
+        try:
+            EllAsyncResult(result, EllLookupResult).get()
+            done.add(key)
+        except Exception as e:
+            logger.error('Failed to update %s %s: %s\n%s' %
+                (what, key, e, traceback.format_exc()))
+
+    pending = deque()
+    for key, write in writes:
+        logger.info('Updating %s %s' % (what, key))
+        try:
+            pending.append((key, write()))
+        except Exception as e:
+            logger.error('Failed to update %s %s: %s\n%s' %
+                (what, key, e, traceback.format_exc()))
+        if len(pending) >= window:
+            wait(*pending.popleft())
+
+    while pending:
+        wait(*pending.popleft())
+
+    return done
+
+
 class Infrastructure(object):
 
     TASK_SYNC = 'infrastructure_sync'
@@ -38,6 +74,10 @@ class Infrastructure(object):
 
     TASK_DC_CACHE_SYNC = 'infrastructure_dc_cache_sync'
 
+    # tags group version stamps, which are stored in the same object
+    # as group states and are listed along with them
+    VERSION_STAMP = 'version_stamp'
+
     RSYNC_CMD = ('rsync -rlHpogDt --progress '
                  '"{user}@{src_host}:{src_path}data*" "{dst_path}"')
     RSYNC_MODULE_CMD = ('rsync -av --progress '
@@ -54,11 +94,19 @@ class Infrastructure(object):
 
         self.state = {}
         self.__state_lock = threading.Lock()
+        # keeps group state writes in the order of state changes
+        self.__write_lock = threading.Lock()
+        self.write_window = config.get('infrastructure_write_window', 50)
+        self.history_length = config.get('infrastructure_history_length', 20)
         self.sync_ts = None
+        self.full_sync_ts = None
+        self.full_sync_period = config.get('infrastructure_full_sync_period', 600)
         self.state_valid_time = config.get('infrastructure_state_valid_time',
                                            120)
-        self.__tq = timed_queue.TimedQueue()
-        self.__tq.start()
+        self.__tq = timed_queue.shared_queue().register('infrastructure')
+        # state sync and update both replace group states
+        self.__state_tq = timed_queue.shared_queue().register(
+            'infrastructure_state', exclusive=True)
 
     def init(self, node):
         self.node = node
@@ -78,81 +126,160 @@ class Infrastructure(object):
             keys.MM_HOSTTREE_CACHE_IDX, keys.MM_HOSTTREE_CACHE_HOST, self.__tq)
         self.hosttree_cache._sync_cache()
 
-        self.__tq.add_task_in(self.TASK_UPDATE,
+        self.__state_tq.add_task_in(self.TASK_UPDATE,
             config.get('infrastructure_update_period', 300),
             self._update_state)
 
-    def get_group_history(self, group_id):
+    def get_group_history(self, group_id, page=None):
+        """Returns the recent group history or an archived history page.
+
+        Pages are numbered from the oldest one, 'pages' is the number
+        of archived pages."""
+        history = self.state[group_id]
+        pages = history.get('archived', 0)
+        if page is not None:
+            if not 0 <= page < pages:
+                raise ValueError('Group %d history has %d archived pages' %
+                                 (group_id, pages))
+            history = self._unserialize(EllAsyncResult(
+                self.meta_session.read_data(keys.MM_ISTRUCT_GROUP_ARCHIVE % (group_id, page)),
+                EllReadResult).get()[0].data)
+
         couples_history = []
-        for couple in self.state[group_id]['couples']:
+        for couple in history['couples']:
             couples_history.append({'couple': couple['couple'],
                                     'timestamp': couple['timestamp']})
         nodes_history = []
-        for node_set in self.state[group_id]['nodes']:
+        for node_set in history['nodes']:
             nodes_history.append({'set': [node + (port_to_path(node[1]),)
                                           for node in node_set['set']],
                                   'timestamp': node_set['timestamp'],
                                   'manual': node_set.get('manual', False)})
         return {'couples': couples_history,
-                'nodes': nodes_history}
+                'nodes': nodes_history,
+                'pages': pages}
 
     def _sync_state(self):
         try:
-            logger.info('Syncing infrastructure state')
-            group_ids = set()
-            with self.__state_lock:
-
-                idxs = self.meta_session.find_all_indexes([keys.MM_GROUPS_IDX])
-                for idx in idxs:
-                    data = idx.indexes[0].data
-
-                    state_group = self._unserialize(data)
-                    logger.debug('Fetched infrastructure item: %s' %
-                                  (state_group,))
-
-                    if (self.state.get(state_group['id']) and
-                        state_group['id'] in storage.groups):
-
-                        group = storage.groups[state_group['id']]
+            full = (self.full_sync_ts is None or
+                    time.time() - self.full_sync_ts > self.full_sync_period)
+            logger.info('Syncing infrastructure state (%s)' %
+                        ('full' if full else 'incremental'))
 
-                        for nodes_state in reversed(state_group['nodes']):
-                            if nodes_state['timestamp'] <= self.state[state_group['id']]['nodes'][-1]['timestamp']:
-                                break
-
-                            if nodes_state.get('manual', False):
-                                nodes_set = set(nodes_state['set'])
-                                for node in group.nodes:
-                                    if not (node.host.addr, node.port) in nodes_set:
-                                        logger.info('Removing {0} from group {1} due to manual group detaching'.format(node, group.group_id))
-                                        group.remove_node(node)
-                            group.update_status_recursive()
-
-                    self.state[state_group['id']] = state_group
-                    group_ids.add(state_group['id'])
+            if full:
+                group_states = self._fetch_all_groups()
+            else:
+                group_states = self._fetch_changed_groups()
 
-                for gid in set(self.state.keys()) - group_ids:
-                    logger.info('Group %d is not found in infrastructure state, '
-                                 'removing' % gid)
-                    del self.state[gid]
+            self._apply_group_states(group_states, full)
 
+            if full:
+                self.full_sync_ts = time.time()
             self.sync_ts = time.time()
 
-            logger.info('Finished syncing infrastructure state')
+            logger.info('Finished syncing infrastructure state, '
+                        '%d groups fetched' % len(group_states))
         except Exception as e:
             logger.error('Failed to sync infrastructure state: %s\n%s' %
                           (e, traceback.format_exc()))
+            # next sync should fetch everything
+            self.full_sync_ts = None
         finally:
-            self.__tq.add_task_in(self.TASK_SYNC,
+            self.__state_tq.add_task_in(self.TASK_SYNC,
                 config.get('infrastructure_sync_period', 60),
                 self._sync_state)
 
+    def _fetch_all_groups(self):
+        group_states = []
+        for idx in self.meta_session.find_all_indexes([keys.MM_GROUPS_IDX]):
+            group_states.append(self._unserialize(idx.indexes[0].data))
+        return group_states
+
+    def _fetch_changed_groups(self):
+        """Fetches states of the groups which version stamps differ
+        from the local ones"""
+        changed = []
+        for idx in self.meta_session.find_all_indexes([keys.MM_GROUPS_VERSIONS_IDX]):
+            stamp = msgpack.unpackb(idx.indexes[0].data)
+            group_id, version = stamp['id'], stamp[self.VERSION_STAMP]
+            group_state = self.state.get(group_id)
+            if group_state is None or group_state.get('version', 0) != version:
+                changed.append(group_id)
+
+        logger.info('Infrastructure state changed for %d groups' % len(changed))
+
+        results = [(group_id, self.meta_session.list_indexes(
+                        elliptics.Id(keys.MM_ISTRUCT_GROUP % group_id)))
+                   for group_id in changed]
+
+        group_states = []
+        for group_id, result in results:
+            for entry in result.get():
+                data = msgpack.unpackb(entry.data)
+                if self.VERSION_STAMP in data:
+                    continue
+                group_states.append(self._normalize(data))
+                break
+            else:
+                logger.warn('State of group %d is not found' % group_id)
+        return group_states
+
+    def _apply_group_states(self, group_states, full):
+        """Replaces local group states with the fetched ones.
+
+        For a full sync groups missing in the fetched list are removed."""
+        with self.__state_lock:
+            state = dict(self.state)
+
+            for state_group in group_states:
+                logger.debug('Fetched infrastructure item: %s' %
+                              (state_group,))
+
+                cur_state_group = state.get(state_group['id'])
+
+                if (cur_state_group and
+                        cur_state_group.get('version', 0) > state_group.get('version', 0)):
+                    # local state has not been written yet
+                    continue
+
+                if (cur_state_group and cur_state_group['nodes'] and
+                    state_group['id'] in storage.groups):
+
+                    group = storage.groups[state_group['id']]
+
+                    for nodes_state in reversed(state_group['nodes']):
+                        if nodes_state['timestamp'] <= cur_state_group['nodes'][-1]['timestamp']:
+                            break
+
+                        if nodes_state.get('manual', False):
+                            nodes_set = set(nodes_state['set'])
+                            for node in group.nodes:
+                                if not (node.host.addr, node.port) in nodes_set:
+                                    logger.info('Removing {0} from group {1} due to manual group detaching'.format(node, group.group_id))
+                                    group.remove_node(node)
+                        group.update_status_recursive()
+
+                state[state_group['id']] = state_group
+
+            if full:
+                group_ids = set(state_group['id'] for state_group in group_states)
+                for gid in set(state.keys()) - group_ids:
+                    logger.info('Group %d is not found in infrastructure state, '
+                                 'removing' % gid)
+                    del state[gid]
+
+            self.state = state
+
     @staticmethod
     def _serialize(data):
         return msgpack.packb(data)
 
     @staticmethod
     def _unserialize(data):
-        group_state = msgpack.unpackb(data)
+        return Infrastructure._normalize(msgpack.unpackb(data))
+
+    @staticmethod
+    def _normalize(group_state):
         group_state['nodes'] = list(group_state['nodes'])
         if not 'couples' in group_state:
             group_state['couples'] = []
@@ -241,25 +368,25 @@ class Infrastructure(object):
                         new_couple = storage_couple
 
                     if new_nodes or new_couple:
-                        try:
-                            self._update_group(g.group_id, new_nodes, new_couple)
-                        except Exception as e:
-                            logger.error('Failed to update infrastructure state for group %s: %s\n%s' %
-                                (g.group_id, e, traceback.format_exc()))
-                            pass
+                        self._update_group(g.group_id, new_nodes, new_couple)
+                        groups_to_update.append(g.group_id)
 
+            self._write_groups(groups_to_update)
 
             logger.info('Finished updating infrastructure state')
         except Exception as e:
             logger.error('Failed to update infrastructure state: %s\n%s' %
                           (e, traceback.format_exc()))
         finally:
-            self.__tq.add_task_in(self.TASK_UPDATE,
+            self.__state_tq.add_task_in(self.TASK_UPDATE,
                 config.get('infrastructure_update_period', 300),
                 self._update_state)
 
     def _update_group(self, group_id, new_nodes, new_couple, manual=False):
+        """Appends new nodes and couple to the group history,
+        should be called under the state lock"""
         group = self.state[group_id]
+        group['version'] = time.time()
         if new_nodes:
             new_nodes_state = {'set': new_nodes,
                                'timestamp': time.time()}
@@ -273,10 +400,101 @@ class Infrastructure(object):
                                  'timestamp': time.time()}
             group['couples'].append(new_couples_state)
 
-        eid = elliptics.Id(keys.MM_ISTRUCT_GROUP % group_id)
-        logger.info('Updating state for group %s' % group_id)
-        self.meta_session.update_indexes(eid, [keys.MM_GROUPS_IDX],
-                                              [self._serialize(group)])
+    def _write_groups(self, group_ids):
+        """Writes state of the groups to the index.
+
+        Group histories are compacted and states are serialized under
+        the state lock, writes are issued outside of it."""
+        if not group_ids:
+            return
+
+        with self.__write_lock:
+            with self.__state_lock:
+                segments = []
+                for group_id in group_ids:
+                    segment = self._archive_segment(self.state[group_id])
+                    if segment:
+                        segments.append((group_id,) + segment)
+
+            archived = write_many(
+                ((group_id, partial(self.meta_session.write_data,
+                                   keys.MM_ISTRUCT_GROUP_ARCHIVE % (group_id, segment['page']),
+                                   self._serialize(segment)))
+                 for group_id, segment, _ in segments),
+                self.write_window, 'archive of group')
+
+            with self.__state_lock:
+                for group_id, segment, trim in segments:
+                    if group_id in archived:
+                        self._trim_history(self.state[group_id], segment['page'], trim)
+                datas = [(group_id, self._serialize(self.state[group_id]),
+                          self._serialize({'id': group_id,
+                                           self.VERSION_STAMP: self.state[group_id]['version']}))
+                         for group_id in group_ids]
+
+            logger.info('Updating state for %d groups' % len(datas))
+
+            write_many(
+                ((group_id, partial(self.meta_session.update_indexes,
+                                    elliptics.Id(keys.MM_ISTRUCT_GROUP % group_id),
+                                    [keys.MM_GROUPS_IDX, keys.MM_GROUPS_VERSIONS_IDX],
+                                    [data, version]))
+                 for group_id, data, version in datas),
+                self.write_window, 'infrastructure state for group')
+
+    def _archive_segment(self, group_state):
+        """Returns the oldest part of the group history that should
+        be moved to the archive along with the trim position or None
+        if the history is short enough.
+
+        Only the last history_length transitions are kept in the group
+        state, consecutive duplicate transitions of the archived part
+        are coalesced."""
+        nodes = group_state['nodes'][:-self.history_length]
+        couples = group_state['couples'][:-self.history_length]
+        if max(len(nodes), len(couples)) < self.history_length:
+            return None
+        segment = {'page': group_state.get('archived', 0),
+                   'nodes': self._coalesce(nodes, self._nodes_set),
+                   'couples': self._coalesce(couples, self._couple_set)}
+        trim = (len(nodes), nodes and nodes[-1]['timestamp'],
+                len(couples), couples and couples[-1]['timestamp'])
+        return segment, trim
+
+    @staticmethod
+    def _coalesce(entries, key):
+        """Drops entries repeating the previous one,
+        key returns comparable value of an entry"""
+        res = []
+        for entry in entries:
+            if (res and key(res[-1]) == key(entry) and
+                    res[-1].get('manual', False) == entry.get('manual', False)):
+                continue
+            res.append(entry)
+        return res
+
+    @staticmethod
+    def _nodes_set(entry):
+        return set(tuple(node) for node in entry['set'])
+
+    @staticmethod
+    def _couple_set(entry):
+        return set(entry['couple'])
+
+    @staticmethod
+    def _trim_history(group_state, page, trim):
+        nodes_count, nodes_ts, couples_count, couples_ts = trim
+        # state could have been replaced by sync since the segment was composed
+        if (len(group_state['nodes']) < nodes_count or
+                len(group_state['couples']) < couples_count):
+            return
+        if ((nodes_count and group_state['nodes'][nodes_count - 1]['timestamp'] != nodes_ts) or
+                (couples_count and group_state['couples'][couples_count - 1]['timestamp'] != couples_ts)):
+            return
+        del group_state['nodes'][:nodes_count]
+        del group_state['couples'][:couples_count]
+        group_state['archived'] = page + 1
+        group_state['version'] = time.time()
 
     def detach_node(self, group, host, port):
         with self.__state_lock:
@@ -298,6 +516,8 @@ class Infrastructure(object):
 
             self._update_group(group.group_id, state_nodes, None, manual=True)
 
+        self._write_groups([group.group_id])
+
 
     def restore_group_cmd(self, request):
         group_id = int(request[0])
@@ -409,6 +629,23 @@ class Infrastructure(object):
                      (group_id, addr, warns, cmd))
         return addr, cmd, warns
 
+    def prefetch_host_caches(self):
+        """Resolves missing and expired items of host caches
+        for all the known hosts"""
+        workers = config.get('infrastructure_cache_prefetch_workers', 16)
+        addrs = [host.addr for host in storage.hosts.keys()]
+        logger.info('Prefetching host caches for %d hosts' % len(addrs))
+
+        self.dc_cache.prefetch(addrs, workers)
+        self.hostname_cache.prefetch(addrs, workers)
+
+        hostnames = []
+        for addr in addrs:
+            cache_item = self.hostname_cache.cache.get(addr)
+            if cache_item:
+                hostnames.append(cache_item['val'])
+        self.hosttree_cache.prefetch(hostnames, workers)
+
     def get_dc_by_host(self, host):
         return self.dc_cache[host]
 
@@ -419,6 +656,26 @@ class Infrastructure(object):
         return self.hosttree_cache[hostname]
 
 
+class _Flight(object):
+    """Value fetch shared by concurrent requests of the same key"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.val = None
+        self.error = None
+
+    def done(self, val=None, error=None):
+        self.val = val
+        self.error = error
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.error:
+            raise self.error
+        return self.val
+
+
 class CacheItem(object):
 
     def __init__(self, meta_session, idx_key, key_key, tq):
@@ -428,11 +685,28 @@ class CacheItem(object):
         self.__tq = tq
         self.cache = {}
 
+        # source errors are cached for a short time
+        self.failure_expire_time = config.get('infrastructure_cache_failure_valid_time', 60)
+        self.__failures = {}
+        self.__flights = {}
+        self.__flights_lock = threading.Lock()
+
+        # updated items are written to the index in batches
+        self.flush_period = config.get('infrastructure_cache_flush_period', 5)
+        self.write_window = config.get('infrastructure_write_window', 50)
+        self.__dirty = {}
+        self.__dirty_lock = threading.Lock()
+        self.__flush_scheduled = False
+
         for attr in ['taskname', 'logprefix', 'sync_period', 'key_expire_time']:
             if getattr(self, attr) is None:
                 raise AttributeError('Set "{0}" attribute explicitly in your '
                                  'class instance'.format(attr))
 
+        # cache sync and flush are serialized, refreshes of different
+        # keys are scheduled in the shared tq and run independently
+        self.__sync_tq = timed_queue.shared_queue().register(self.taskname,
+                                                             exclusive=True)
     def get_value(self, key):
         raise NotImplemented('Method "get_value" should be implemented in '
                              'derived class')
@@ -457,43 +731,165 @@ class CacheItem(object):
             logger.error(self.logprefix + 'Failed to sync: %s\n%s' %
                           (e, traceback.format_exc()))
         finally:
-            self.__tq.add_task_in(self.taskname,
+            self.__sync_tq.add_task_in(self.taskname,
                 self.sync_period, self._sync_cache)
 
     def _update_cache_item(self, key, val):
-        eid = elliptics.Id(self.key_key % key)
         cache_item = {'key': key,
                       'val': val,
                       'ts': time.time()}
         logger.info(self.logprefix + 'Updating item for key %s '
                                       'to value %s' % (key, val))
-        self.meta_session.update_indexes(eid, [self.idx_key],
-                                              [msgpack.packb(cache_item)])
         self.cache[key] = cache_item
+        with self.__dirty_lock:
+            self.__dirty[key] = cache_item
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        with self.__dirty_lock:
+            if self.__flush_scheduled or not self.__dirty:
+                return
+            self.__flush_scheduled = True
+        self.__sync_tq.add_task_in(self.taskname + '_flush',
+            self.flush_period, self._flush)
+
+    def _flush(self):
+        """Writes updated items to the index, only the latest
+        update of a key is written"""
+        with self.__dirty_lock:
+            dirty, self.__dirty = self.__dirty, {}
+            self.__flush_scheduled = False
+
+        logger.info(self.logprefix + 'Flushing %d items' % len(dirty))
+        written = write_many(
+            ((key, partial(self.meta_session.update_indexes,
+                           elliptics.Id(self.key_key % key), [self.idx_key],
+                           [msgpack.packb(cache_item)]))
+             for key, cache_item in dirty.iteritems()),
+            self.write_window, self.logprefix + 'item for key')
+
+        failed = set(dirty) - written
+        if failed:
+            logger.info(self.logprefix + 'Postponing %d failed items' % len(failed))
+            with self.__dirty_lock:
+                for key in failed:
+                    # newer update of the key could have been made meanwhile
+                    self.__dirty.setdefault(key, dirty[key])
+            self._schedule_flush()
 
     def __getitem__(self, key):
-        try:
-            cache_item = self.cache[key]
-            if cache_item['ts'] + self.key_expire_time < time.time():
-                logger.debug(self.logprefix + 'Item for key %s expired' % (key,))
-                raise KeyError
+        cache_item = self.cache.get(key)
+        if cache_item is None:
+            return self._fetch(key)
+
+        if cache_item['ts'] + self.key_expire_time < time.time():
+            logger.debug(self.logprefix + 'Item for key %s expired, '
+                                          'refreshing' % (key,))
+            self._refresh(key)
+        else:
             logger.debug(self.logprefix + 'Using item for key %s from cache' % (key,))
-            val = cache_item['val']
-        except KeyError:
-            logger.debug(self.logprefix + 'Fetching value for key %s from source' % (key,))
-            try:
-                req_start = time.time()
-                val = self.get_value(key)
-                logger.info(self.logprefix + 'Fetched value for key %s from source: %s' %
-                             (key, val))
-            except Exception as e:
-                req_time = time.time() - req_start
-                logger.error(self.logprefix + 'Failed to fetch value for key {0} (time: {1:.5f}s): {2}\n{3}'.format(
-                    key, req_time, str(e), traceback.format_exc()))
-                raise
+
+        # stale value is used until the refreshed one is fetched
+        return cache_item['val']
+
+    def prefetch(self, keys, workers):
+        """Fetches missing and expired items concurrently"""
+        now = time.time()
+        keys = [key for key in set(keys)
+                if not key in self.cache or
+                   self.cache[key]['ts'] + self.key_expire_time < now]
+        if not keys:
+            return
+
+        logger.info(self.logprefix + 'Prefetching %d items' % len(keys))
+        pool = ThreadPool(min(workers, len(keys)))
+        try:
+            pool.map(self._fetch_quietly, keys)
+        finally:
+            pool.close()
+            pool.join()
+        logger.info(self.logprefix + 'Finished prefetching')
+
+    def _fetch(self, key):
+        """Fetches value from the source.
+
+        Concurrent requests of the same key wait for the single fetch,
+        recently failed keys fail immediately."""
+        with self.__flights_lock:
+            failure = self.__failures.get(key)
+            if failure and failure[0] + self.failure_expire_time >= time.time():
+                raise failure[1]
+            flight = self.__flights.get(key)
+            if flight:
+                leader = False
+            else:
+                leader = True
+                flight = self.__flights[key] = _Flight()
+
+        if leader:
+            self._fetch_flight(key, flight)
+        return flight.wait()
+
+    def _fetch_quietly(self, key):
+        try:
+            self._fetch(key)
+        except Exception:
+            # error is already logged
+            pass
+
+    def _refresh(self, key):
+        """Schedules background fetch of the key unless
+        it is already being fetched or recently failed"""
+        with self.__flights_lock:
+            failure = self.__failures.get(key)
+            if failure and failure[0] + self.failure_expire_time >= time.time():
+                return
+            if key in self.__flights:
+                return
+            flight = self.__flights[key] = _Flight()
+
+        try:
+            self.__tq.add_task_in(self.taskname + '_refresh_%s' % (key,), 0,
+                                  self._fetch_flight, key, flight)
+        except Exception as e:
+            logger.error(self.logprefix + 'Failed to schedule refresh '
+                                          'for key %s: %s' % (key, e))
+            with self.__flights_lock:
+                del self.__flights[key]
+            # requests waiting for the flight get the stale value
+            cache_item = self.cache.get(key)
+            if cache_item is not None:
+                flight.done(cache_item['val'])
+            else:
+                flight.done(error=e)
+
+    def _fetch_flight(self, key, flight):
+        logger.debug(self.logprefix + 'Fetching value for key %s from source' % (key,))
+        req_start = time.time()
+        try:
+            val = self.get_value(key)
+            logger.info(self.logprefix + 'Fetched value for key %s from source: %s' %
+                         (key, val))
+        except Exception as e:
+            req_time = time.time() - req_start
+            logger.error(self.logprefix + 'Failed to fetch value for key {0} (time: {1:.5f}s): {2}\n{3}'.format(
+                key, req_time, str(e), traceback.format_exc()))
+            with self.__flights_lock:
+                self.__failures[key] = (time.time(), e)
+                del self.__flights[key]
+            flight.done(error=e)
+            return
+
+        try:
             self._update_cache_item(key, val)
+        except Exception as e:
+            logger.error(self.logprefix + 'Failed to update item for key %s: %s\n%s' %
+                         (key, e, traceback.format_exc()))
 
-        return val
+        with self.__flights_lock:
+            self.__failures.pop(key, None)
+            del self.__flights[key]
+        flight.done(val)
 
 
 class DcCacheItem(CacheItem):
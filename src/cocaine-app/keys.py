@@ -5,7 +5,9 @@ MASTERMIND_MAX_GROUP_KEY = 'mastermind:max_group'
 MASTERMIND_COUPLE_META_KEY = 'mastermind:couple_meta:%s'
 
 MM_GROUPS_IDX = 'mastermind:groups_idx'
+MM_GROUPS_VERSIONS_IDX = 'mastermind:groups_versions_idx'
 MM_ISTRUCT_GROUP = 'mastermind:group_%d'
+MM_ISTRUCT_GROUP_ARCHIVE = 'mastermind:group_%d:archive_%d'
 
 MM_DC_CACHE_IDX = 'mastermind:dc_cache'
 MM_DC_CACHE_HOST = 'mastermind:dc_cache_%s'
@@ -40,6 +40,8 @@ class Minions(object):
         self.history = {}
         self.active_hosts = []
 
+        # minions use their own queue, because tasks rely on
+        # the ioloop created in the queue thread
         self.__tq = timed_queue.TimedQueue()
         self.__tq.start()
 
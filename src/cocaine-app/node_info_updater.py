@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
+from collections import deque
 from contextlib import contextmanager
 import functools
 import json
+import os
+import Queue
 import sys
 import threading
 import time
 import traceback
 
-from cocaine.services import Service
 import elliptics
+import msgpack
 
 import balancer
 import balancelogicadapter as bla
@@ -27,21 +30,80 @@ COUPLES_META_UPDATE_TASK_ID = 'update_meta_for_couples'
 class NodeInfoUpdater:
 
     STORAGE_STATE_CACHE_KEY = 'mastermind_storage'
-    STORAGE_STATE_VERSION = '1'
+    DEFAULT_STORAGE_STATE_DIR = '/var/tmp/'
     DEFAULT_STORAGE_STATE_VALID_TIME = 600
 
-    def __init__(self, logging, node):
+    def __init__(self, logging, node, balancer):
         logging.info("Created NodeInfoUpdater")
         self.__logging = logging
         self.__node = node
-        self.__tq = timed_queue.TimedQueue()
-        self.__tq.start()
+        self.__balancer = balancer
+        self.__tq = timed_queue.shared_queue().register('node_info_updater',
+                                                        exclusive=True)
         self.__session = elliptics.Session(self.__node)
         self.__session.set_timeout(config.get('wait_timeout', 5))
         self.__nodeUpdateTimestamps = (time.time(), time.time())
-        self.__cache = Service('cache')
+        self.__force_meta_update = False
+        self.__state_path = os.path.join(
+            config.get('storage_state_dir', self.DEFAULT_STORAGE_STATE_DIR),
+            self.STORAGE_STATE_CACHE_KEY)
 
-        self.loadNodes(delayed=False)
+        # set when storage contains data that can be served
+        self.ready = threading.Event()
+
+        if self.load_storage_state():
+            # storage is warm, handlers can be served while
+            # the actual state is being fetched
+            self.ready.set()
+
+        # node needs some time to collect routes before
+        # statistics can be requested
+        self.__tq.add_task_in('load_nodes', config.get('wait_timeout', 5),
+                              self.loadNodes, delayed=False)
+
+    def load_storage_state(self):
+        try:
+            with open(self.__state_path, 'rb') as f:
+                state = msgpack.unpackb(f.read())
+        except IOError as e:
+            self.__logging.info('No storage state to restore: {0}'.format(e))
+            return False
+        except Exception as e:
+            self.__logging.error('Failed to read storage state: {0}\n{1}'.format(
+                e, traceback.format_exc()))
+            return False
+
+        valid_time = config.get('storage_cache_valid_time',
+                                self.DEFAULT_STORAGE_STATE_VALID_TIME)
+        if state.get('ts', 0) + valid_time < time.time():
+            self.__logging.info('Storage state is too old ({0}), '
+                'skipping'.format(storage.ts_str(state.get('ts', 0))))
+            return False
+
+        try:
+            storage.load_state(state)
+            self.__balancer.update_group_weights()
+        except Exception as e:
+            self.__logging.error('Failed to restore storage state: {0}\n{1}'.format(
+                e, traceback.format_exc()))
+            return False
+
+        self.__logging.info('Restored storage state dumped at {0}: {1} nodes, '
+            '{2} groups, {3} couples'.format(storage.ts_str(state['ts']),
+                len(state['nodes']), len(state['groups']), len(state['couples'])))
+        return True
+
+    def save_storage_state(self):
+        try:
+            data = msgpack.packb(storage.dump_state())
+            tmp_path = self.__state_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, self.__state_path)
+            self.__logging.info('Saved storage state ({0} bytes)'.format(len(data)))
+        except Exception as e:
+            self.__logging.error('Failed to save storage state: {0}\n{1}'.format(
+                e, traceback.format_exc()))
 
     def execute_tasks(self, delayed):
         try:
@@ -90,11 +152,14 @@ class NodeInfoUpdater:
         finally:
             reload_period = config.get('nodes_reload_period', 60)
             self.__tq.add_task_in("load_nodes", reload_period, self.loadNodes)
+            self.ready.set()
             self.__nodeUpdateTimestamps = self.__nodeUpdateTimestamps[1:] + (time.time(),)
             bla.setConfigValue("dynamic_too_old_age", max(time.time() - self.__nodeUpdateTimestamps[0], reload_period * 3))
 
     def force_nodes_update(self, request):
         self.__logging.info('Forcing nodes update')
+        # metas are parsed again even if they did not change
+        self.__force_meta_update = True
         try:
             self.__tq.add_task_in('load_nodes', 0, self.loadNodes)
             self.__logging.info('Task for nodes update was created successfully')
@@ -105,18 +170,20 @@ class NodeInfoUpdater:
 
     def update_symm_groups_async(self):
 
-        _queue = set()
+        force_update = self.__force_meta_update
+
         def _process_group_metadata(meta, group):
 
+            if (not force_update and meta == group.raw_meta and
+                    group.meta is not None and group.couple is not None):
+                self.__logging.debug('Symmetric groups of group {0} '
+                    'did not change'.format(group.group_id))
+                return False
+
             group.parse_meta(meta)
             couples = group.meta['couple']
             self.__logging.info('Read symmetric groups from group '
                 '{0}: {1}'.format(group.group_id, couples))
-            for group_id2 in couples:
-                if group_id2 != group.group_id:
-                    self.__logging.info('Scheduling update '
-                        'for group {0}'.format(group_id2))
-                    _queue.add(group_id2)
 
             couple_str = ':'.join((str(g) for g in sorted(couples)))
 
@@ -134,7 +201,7 @@ class NodeInfoUpdater:
                         storage.groups.add(gid)
                 c = storage.couples.add([storage.groups[gid] for gid in couples])
                 self.__logging.info('Created couple {0} {1}'.format(c, repr(c)))
-            return
+            return True
 
         try:
             requests = []
@@ -149,25 +216,22 @@ class NodeInfoUpdater:
                 group_id = group.group_id
                 requests.append((functools.partial(_session_setup, self.__session, [group_id]),
                                  group_id, keys.SYMMETRIC_GROUPS_KEY))
-            results = self._parallel_read(requests)
-            [group.parse_meta(None) for group in groups if not group.group_id in results]
-
-            while results:
-                if _queue:
-                    group_id = _queue.pop()
-                    if group_id not in results:
-                        continue
-                    result = results.pop(group_id)
-                else:
-                    group_id, result = results.popitem()
+
+            for group_id, result in self._pipelined_read(requests):
 
                 group = storage.groups[group_id]
 
+                if result is None:
+                    group.parse_meta(None)
+                    storage.status_tracker.mark_group(group)
+                    continue
+
+                changed = True
                 try:
                     self.__logging.debug('Reading symmetric groups '
                         'from group {0}'.format(group.group_id))
-                    self._process_elliptics_response(_process_group_metadata,
-                                                     result, group)
+                    changed = self._process_elliptics_response(
+                        _process_group_metadata, result, group)
                 except ValueError as e:
                     self.__logging.warn('Failed to read symmetric_groups '
                         'from group {0}: {1}'.format(group_id, e))
@@ -178,7 +242,10 @@ class NodeInfoUpdater:
                             group_id, e, traceback.format_exc()))
                     group.parse_meta(None)
                 finally:
-                    group.update_status_recursive()
+                    if changed:
+                        storage.status_tracker.mark_group(group)
+
+            storage.status_tracker.update_statuses()
 
         except Exception as e:
             self.__logging.error('Critical error during symmetric group '
@@ -186,6 +253,19 @@ class NodeInfoUpdater:
                                      traceback.format_exc()))
 
     def update_couples_meta_async(self):
+
+        force_update = self.__force_meta_update
+        self.__force_meta_update = False
+
+        def _process_couple_metadata(meta, couple):
+            if not force_update and meta == couple.raw_meta and couple.meta is not None:
+                self.__logging.debug('Couple {0} metadata did not change'.format(couple))
+                return False
+            couple.parse_meta(meta)
+            self.__logging.info('Updated couple metadata (frozen) '
+                'for couple {0}'.format(str(couple)))
+            return True
+
         try:
             requests = []
 
@@ -194,54 +274,119 @@ class NodeInfoUpdater:
             for couple in couples:
                 requests.append((self.__node.meta_session, couple,
                                  keys.MASTERMIND_COUPLE_META_KEY % str(couple)))
-            results = self._parallel_read(requests)
-            [couple.parse_meta(None) for couple in couples if not couple in results]
 
-            while results:
-                couple, result = results.popitem()
+            for couple, result in self._pipelined_read(requests):
+
+                if result is None:
+                    couple.parse_meta(None)
+                    storage.status_tracker.mark_couple(couple)
+                    continue
+
+                changed = True
                 try:
                     self.__logging.debug('Reading couple {0} metadata'.format(
                         str(couple)))
-                    self._process_elliptics_response(couple.parse_meta, result)
-                    self.__logging.info('Updated couple metadata (frozen) '
-                        'for couple {0}'.format(str(couple)))
+                    changed = self._process_elliptics_response(
+                        _process_couple_metadata, result, couple)
                 except ValueError as e:
                     self.__logging.debug('Failed to read couple {0} metadata: '
                         '{1}'.format(couple, e))
+                    # key is not found for couples without metadata
+                    changed = force_update or couple.meta is not None
                     couple.parse_meta(None)
                 except Exception as e:
                     self.__logging.error('Failed to read couple {0} metadata: '
                         '{1}, {2}'.format(couple, e, traceback.format_exc()))
                     couple.parse_meta(None)
                 finally:
-                    couple.update_status()
+                    if changed:
+                        storage.status_tracker.mark_couple(couple)
+
+            storage.status_tracker.update_statuses()
+
+            self.__balancer.update_group_weights()
+
+            self.save_storage_state()
 
         except Exception as e:
             self.__logging.error('Critical error during couples metadata '
                                  'update, {0}: {1}'.format(str(e),
                                      traceback.format_exc()))
 
-    def _parallel_read(self, requests):
-        results = {}
-        for session, result_key, key in requests:
-            if callable(session):
-                session = session()
+    def _pipelined_read(self, requests):
+        """Reads keys keeping at most 'meta_read_window' requests in flight.
+
+        Yields (result_key, result) pairs in order of requests completion,
+        result is None if request could not be sent. Completions are
+        reported by result callbacks, so a slow request does not hold
+        the results of the others or the window refill.
+
+        Requests that timed out are resent up to 'meta_read_retries' times
+        with the same session: group metadata exists only in its own group,
+        and meta session reads already query all of the meta groups,
+        so there is no other replica to fall back to."""
+        window = config.get('meta_read_window', 100)
+        retries = config.get('meta_read_retries', 1)
+
+        pending = deque((request, 0) for request in requests)
+        completed = Queue.Queue()
+        in_flight = 0
+
+        while pending or in_flight:
+            while pending and in_flight < window:
+                request, attempt = pending.popleft()
+                result = self._read(*request)
+                in_flight += 1
+                self._on_complete(result, completed.put, (request, attempt, result))
+
+            request, attempt, result = completed.get()
+            in_flight -= 1
+            session, result_key, key = request
+            if (result is not None and attempt < retries and
+                    self._timed_out(result)):
+                self.__logging.info('Read {0} for groups {1} timed out, '
+                    'retrying'.format(key.replace('\0', '\\0'), result_key))
+                pending.appendleft((request, attempt + 1))
+                continue
+            yield result_key, result
 
-            # read_latest_async is for elliptics 2.24.14.15, in later versions
-            # read_data returns AsyncResult object
-            self.__logging.debug('Request to read {0} for groups {1}'.format(
-                                 key.replace('\0', '\\0'), result_key))
-            read = getattr(session, 'read_latest_async', session.read_data)
+    @staticmethod
+    def _on_complete(result, callback, *args):
+        """Calls callback when the request is completed,
+        immediately for synchronous and failed requests"""
+        connect = getattr(result, 'connect', None)
+        if connect is None:
+            callback(*args)
+            return
+        connect(lambda entry: None, lambda error: callback(*args))
 
-            try:
-                results[result_key] = read(elliptics.Id(key))
-            except Exception as e:
-                self.__logging.error('Failed to read {0} for groups '
-                    '{1}: {2}, {3}'.format(key, result_key,
-                                           str(e), traceback.format_exc()))
-                pass
+    def _read(self, session, result_key, key):
+        if callable(session):
+            session = session()
+
+        # read_latest_async is for elliptics 2.24.14.15, in later versions
+        # read_data returns AsyncResult object
+        self.__logging.debug('Request to read {0} for groups {1}'.format(
+                             key.replace('\0', '\\0'), result_key))
+        read = getattr(session, 'read_latest_async', session.read_data)
+
+        try:
+            return read(elliptics.Id(key))
+        except Exception as e:
+            self.__logging.error('Failed to read {0} for groups '
+                '{1}: {2}, {3}'.format(key, result_key,
+                                       str(e), traceback.format_exc()))
+            return None
 
-        return results
+    @staticmethod
+    def _timed_out(result):
+        try:
+            result.wait()
+        except elliptics.TimeoutError:
+            return True
+        except Exception:
+            pass
+        return False
 
     @staticmethod
     def _process_elliptics_response(processor, result, *args):
@@ -227,9 +227,8 @@ class Statistics(object):
             namespace = None
 
         if namespace:
-            for couple in storage.couples:
-                if couple.namespace == namespace:
-                    hosts.extend([n.host for g in couple for n in g.nodes])
+            for couple in storage.couples.find('namespace', namespace):
+                hosts.extend([n.host for g in couple for n in g.nodes])
             hosts = list(set(hosts))
         else:
             hosts = storage.hosts.keys()
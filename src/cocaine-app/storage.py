@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
+from array import array
 import datetime
+from itertools import izip
 import logging
+import threading
 import time
 import traceback
 
@@ -15,6 +18,8 @@ logger = logging.getLogger('mm.storage')
 
 
 RPS_FORMULA_VARIANT = config.get('rps_formula', 0)
+# node is stalled when its statistics is older
+NODE_STAT_VALID_TIME = 120
 
 
 def ts_str(ts):
@@ -36,21 +41,97 @@ GOOD_STATUSES = set([Status.OK, Status.FULL])
 NOT_BAD_STATUSES = set([Status.OK, Status.FULL, Status.FROZEN])
 
 
+class RepositaryIndex(object):
+    """Maps index keys to sets of repositary elements.
+
+    keys_func should return an iterable of index keys for an element."""
+
+    def __init__(self, name, keys_func):
+        self.name = name
+        self.keys_func = keys_func
+        self.elements = {}
+        self.element_keys = {}
+        self.__lock = threading.Lock()
+
+    def update(self, e):
+        try:
+            keys = frozenset(self.keys_func(e))
+        except Exception as e_:
+            logger.error('Failed to get index "%s" keys for %s: %s\n%s' %
+                         (self.name, e, e_, traceback.format_exc()))
+            keys = frozenset()
+
+        with self.__lock:
+            old_keys = self.element_keys.get(e, frozenset())
+            if keys == old_keys:
+                return
+            self.__remove(e, old_keys - keys)
+            for key in keys - old_keys:
+                self.elements.setdefault(key, set()).add(e)
+            self.element_keys[e] = keys
+
+    def remove(self, e):
+        with self.__lock:
+            self.__remove(e, self.element_keys.pop(e, frozenset()))
+
+    def __remove(self, e, keys):
+        for key in keys:
+            key_elements = self.elements[key]
+            key_elements.discard(e)
+            if not key_elements:
+                del self.elements[key]
+
+    def find(self, keys):
+        with self.__lock:
+            res = set()
+            for key in keys:
+                res.update(self.elements.get(key, ()))
+            return list(res)
+
+    def keys(self):
+        with self.__lock:
+            return self.elements.keys()
+
+
 class Repositary(object):
     def __init__(self, constructor):
         self.elements = {}
         self.constructor = constructor
+        self.indexes = {}
+
+    def add_index(self, name, keys_func):
+        idx = RepositaryIndex(name, keys_func)
+        for e in self.elements.itervalues():
+            idx.update(e)
+        self.indexes[name] = idx
+
+    def reindex(self, e):
+        if not e in self.elements:
+            return
+        for idx in self.indexes.itervalues():
+            idx.update(e)
+
+    def find(self, index, *keys):
+        """Returns elements having any of the keys in the index"""
+        return self.indexes[index].find(keys)
+
+    def index_keys(self, index):
+        return self.indexes[index].keys()
 
     def add(self, *args, **kwargs):
         e = self.constructor(*args, **kwargs)
         self.elements[e] = e
+        self.reindex(e)
         return e
 
     def get(self, key):
         return self.elements[key]
 
     def remove(self, key):
-        return self.elements.pop(key)
+        e = self.elements.pop(key)
+        for idx in self.indexes.itervalues():
+            idx.remove(e)
+        return e
 
     def __getitem__(self, key):
         return self.get(key)
@@ -68,142 +149,367 @@ class Repositary(object):
         return self.elements.keys()
 
 
-class NodeStat(object):
-    def __init__(self, raw_stat=None, prev=None):
+class StatusTracker(object):
+    """Collects groups and couples whose state has changed and
+    recalculates their statuses once per update pass."""
 
-        if raw_stat:
-            self.init(raw_stat, prev)
-        else:
-            self.free_space = 0.0
-            self.rel_space = 0.0
-            self.load_average = 0.0
+    def __init__(self):
+        self.groups = set()
+        self.couples = set()
+        self.__lock = threading.Lock()
 
-            self.read_rps = 0
-            self.write_rps = 0
-            self.max_read_rps = 0
-            self.max_write_rps = 0
+    def mark_group(self, group):
+        with self.__lock:
+            self.groups.add(group)
 
-            self.fragmentation = 0.0
-            self.files = 0
-            self.files_removed = 0
+    def mark_couple(self, couple):
+        with self.__lock:
+            self.couples.add(couple)
 
-            self.fsid = None
+    def update_statuses(self):
+        with self.__lock:
+            dirty_groups, self.groups = self.groups, set()
+            dirty_couples, self.couples = self.couples, set()
 
-    def max_rps(self, rps, load_avg, variant=RPS_FORMULA_VARIANT):
+        # group status depends on the couple, so coupled groups
+        # are updated along with their couples
+        uncoupled_groups = []
+        for group in dirty_groups:
+            if group.couple:
+                dirty_couples.add(group.couple)
+            else:
+                uncoupled_groups.append(group)
+
+        logger.info('Updating statuses: %d couples, %d uncoupled groups' %
+                    (len(dirty_couples), len(uncoupled_groups)))
+
+        for couple in dirty_couples:
+            if not couple.groups:
+                # couple has been destroyed
+                continue
+            couple.update_status()
+
+        for group in uncoupled_groups:
+            group.update_status()
+
+
+class NodeStatTable(object):
+    """Columnar storage for node statistics.
+
+    Every metric is kept in its own typed array, a NodeStat object
+    occupies one slot (the same index in every column)."""
+
+    COLUMNS = (
+        ('ts', 'd'),
+        ('last_read', 'L'),
+        ('last_write', 'L'),
+        ('total_space', 'd'),
+        ('free_space', 'd'),
+        ('used_space', 'd'),
+        ('rel_space', 'd'),
+        ('load_average', 'd'),
+        ('read_rps', 'd'),
+        ('write_rps', 'd'),
+        ('max_read_rps', 'd'),
+        ('max_write_rps', 'd'),
+        ('fragmentation', 'd'),
+        ('files', 'L'),
+        ('files_removed', 'L'),
+        # fsid is an opaque 64-bit identifier, kept as is
+        ('fsid', None),
+    )
+
+    def __init__(self):
+        self.columns = dict((name, array(typecode) if typecode else [])
+                            for name, typecode in self.COLUMNS)
+        self.size = 0
+        self.free_slots = []
+        self.__lock = threading.RLock()
+
+    def alloc(self):
+        with self.__lock:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+                for column in self.columns.itervalues():
+                    column[slot] = 0
+            else:
+                slot = self.size
+                self.size += 1
+                for column in self.columns.itervalues():
+                    column.append(0)
+        return slot
 
-        if variant == 0:
-            return max(rps / max(load_avg, 0.01), 100)
+    def release(self, slot):
+        with self.__lock:
+            self.free_slots.append(slot)
 
-        rps = max(rps, 1)
-        max_avg_norm = 10.0
-        avg = max(min(float(load_avg), 100.0), 0.0) / max_avg_norm
-        avg_inverted = 10.0 - avg
+    def values(self, name, slots):
+        column = self.columns[name]
+        return [column[slot] for slot in slots]
 
-        if variant == 1:
-            max_rps = ((rps + avg_inverted) ** 2) / rps
-        elif variant == 2:
-            max_rps = ((avg_inverted) ** 2) / rps
-        else:
-            raise ValueError('Unknown max_rps option: %s' % variant)
+    def row(self, slot):
+        return [self.columns[name][slot] for name, _ in self.COLUMNS]
 
-        return max_rps
+    def set_row(self, slot, values):
+        for (name, _), value in izip(self.COLUMNS, values):
+            self.columns[name][slot] = value
 
-    def init(self, raw_stat, prev=None):
-        self.ts = time.time()
+    def set_values(self, slots, values):
+        for name, column_values in values:
+            column = self.columns[name]
+            for slot, value in izip(slots, column_values):
+                column[slot] = value
 
-        self.last_read = raw_stat['storage_commands']['READ'][0] + raw_stat['proxy_commands']['READ'][0]
-        self.last_write = raw_stat['storage_commands']['WRITE'][0] + raw_stat['proxy_commands']['WRITE'][0]
 
-        self.total_space = float(raw_stat['counters']['DNET_CNTR_BLOCKS'][0]) * raw_stat['counters']['DNET_CNTR_BSIZE'][0]
-        self.free_space = float(raw_stat['counters']['DNET_CNTR_BAVAIL'][0]) * raw_stat['counters']['DNET_CNTR_BSIZE'][0]
-        self.used_space = self.total_space - self.free_space
-        self.rel_space = float(raw_stat['counters']['DNET_CNTR_BAVAIL'][0]) / raw_stat['counters']['DNET_CNTR_BLOCKS'][0]
-        self.load_average = (float(raw_stat['counters']['DNET_CNTR_DU1'][0]) / 100
-                             if raw_stat['counters'].get('DNET_CNTR_DU1') else
-                             float(raw_stat['counters']['DNET_CNTR_LA1'][0]) / 100)
+stat_table = NodeStatTable()
 
-        self.fragmentation = (float(raw_stat['counters']['DNET_CNTR_NODE_FILES_REMOVED'][0]) /
-                                 ((raw_stat['counters']['DNET_CNTR_NODE_FILES'][0] +
-                                   raw_stat['counters']['DNET_CNTR_NODE_FILES_REMOVED'][0]) or 1))
-        self.files = raw_stat['counters']['DNET_CNTR_NODE_FILES'][0]
-        self.files_removed = raw_stat['counters']['DNET_CNTR_NODE_FILES_REMOVED'][0]
 
-        self.fsid = raw_stat['counters']['DNET_CNTR_FSID'][0]
+def _stat_column(name):
 
-        if prev:
-            dt = self.ts - prev.ts
+    def getter(self):
+        return stat_table.columns[name][self._slot]
 
-            self.read_rps = (self.last_read - prev.last_read) / dt
-            self.write_rps = (self.last_write - prev.last_write) / dt
+    def setter(self, value):
+        stat_table.columns[name][self._slot] = value
 
-            # Disk usage should be used here instead of load average
-            # self.max_read_rps = max(self.read_rps / max(self.load_average, 0.01), 100)
-            self.max_read_rps = self.max_rps(self.read_rps, self.load_average)
+    return property(getter, setter)
 
-            # self.max_write_rps = max(self.write_rps / max(self.load_average, 0.01), 100)
-            self.max_write_rps = self.max_rps(self.write_rps, self.load_average)
 
-        else:
-            self.read_rps = 0
-            self.write_rps = 0
+class NodeStat(object):
 
-            # Tupical SATA HDD performance is 100 IOPS
-            # It will be used as first estimation for maximum node performance
-            self.max_read_rps = 100
-            self.max_write_rps = 100
+    __slots__ = ('_slot',)
 
-    def __add__(self, other):
+    ts = _stat_column('ts')
+    last_read = _stat_column('last_read')
+    last_write = _stat_column('last_write')
+
+    total_space = _stat_column('total_space')
+    free_space = _stat_column('free_space')
+    used_space = _stat_column('used_space')
+    rel_space = _stat_column('rel_space')
+    load_average = _stat_column('load_average')
+
+    read_rps = _stat_column('read_rps')
+    write_rps = _stat_column('write_rps')
+    max_read_rps = _stat_column('max_read_rps')
+    max_write_rps = _stat_column('max_write_rps')
+
+    fragmentation = _stat_column('fragmentation')
+    files = _stat_column('files')
+    files_removed = _stat_column('files_removed')
+
+    fsid = _stat_column('fsid')
+
+    def __init__(self, raw_stat=None, prev=None):
+        self._slot = stat_table.alloc()
+
+        if raw_stat:
+            self.init(raw_stat, prev)
+
+    def __del__(self):
+        stat_table.release(self._slot)
+
+    def copy(self):
+        """Returns a stat in a separate slot, node stat slots
+        are overwritten in place by statistics updates"""
         res = NodeStat()
+        stat_table.set_row(res._slot, stat_table.row(self._slot))
+        return res
 
-        res.ts = min(self.ts, other.ts)
+    def max_rps(self, rps, load_avg, variant=RPS_FORMULA_VARIANT):
+        return self.max_rps_values([rps], [load_avg], variant=variant)[0]
 
-        res.total_space = self.total_space + other.total_space
-        res.free_space = self.free_space + other.free_space
-        res.used_space = self.used_space + other.used_space
-        res.rel_space = min(self.rel_space, other.rel_space)
-        res.load_average = max(self.load_average, other.load_average)
+    @staticmethod
+    def max_rps_values(rps_values, load_avg_values, variant=RPS_FORMULA_VARIANT):
+        """Estimates maximum node rps for every pair of
+        (rps, load average) values"""
 
-        res.read_rps = self.read_rps + other.read_rps
-        res.write_rps = self.write_rps + other.write_rps
+        if variant == 0:
+            return [max(rps / max(load_avg, 0.01), 100)
+                    for rps, load_avg in izip(rps_values, load_avg_values)]
 
-        res.max_read_rps = self.max_read_rps + other.max_read_rps
-        res.max_write_rps = self.max_write_rps + other.max_write_rps
+        if variant not in (1, 2):
+            raise ValueError('Unknown max_rps option: %s' % variant)
 
-        res.files = self.files + other.files
-        res.files_removed = self.files_removed + other.files_removed
+        max_avg_norm = 10.0
+        rps_values = [max(rps, 1) for rps in rps_values]
+        avg_inverted_values = [10.0 - max(min(float(load_avg), 100.0), 0.0) / max_avg_norm
+                               for load_avg in load_avg_values]
+
+        if variant == 1:
+            return [((rps + avg_inverted) ** 2) / rps
+                    for rps, avg_inverted in izip(rps_values, avg_inverted_values)]
+
+        return [((avg_inverted) ** 2) / rps
+                for rps, avg_inverted in izip(rps_values, avg_inverted_values)]
+
+    def init(self, raw_stat, prev=None):
+        """Fills the stat from raw node statistics.
+
+        prev can be the stat object itself: its values are read
+        before being overwritten."""
+        NodeStat.init_many([self], [raw_stat], [prev])
+
+    @staticmethod
+    def init_many(stats, raw_stats, prevs):
+        """Fills a batch of stats from raw node statistics
+        column by column.
+
+        All the previous values are read before any of the stats
+        is overwritten, so stats can be passed as their own prevs."""
+        ts = time.time()
+
+        counters = [raw_stat['counters'] for raw_stat in raw_stats]
+
+        def counter_values(name):
+            return [c[name][0] for c in counters]
+
+        last_read = [raw_stat['storage_commands']['READ'][0] + raw_stat['proxy_commands']['READ'][0]
+                     for raw_stat in raw_stats]
+        last_write = [raw_stat['storage_commands']['WRITE'][0] + raw_stat['proxy_commands']['WRITE'][0]
+                      for raw_stat in raw_stats]
+
+        blocks = counter_values('DNET_CNTR_BLOCKS')
+        bavail = counter_values('DNET_CNTR_BAVAIL')
+        bsize = counter_values('DNET_CNTR_BSIZE')
+        files = counter_values('DNET_CNTR_NODE_FILES')
+        files_removed = counter_values('DNET_CNTR_NODE_FILES_REMOVED')
+
+        total_space = [float(b) * s for b, s in izip(blocks, bsize)]
+        free_space = [float(a) * s for a, s in izip(bavail, bsize)]
+        used_space = [t - f for t, f in izip(total_space, free_space)]
+        rel_space = [float(a) / b for a, b in izip(bavail, blocks)]
+        load_average = [(float(c['DNET_CNTR_DU1'][0]) / 100
+                         if c.get('DNET_CNTR_DU1') else
+                         float(c['DNET_CNTR_LA1'][0]) / 100)
+                        for c in counters]
+
+        fragmentation = [float(r) / ((f + r) or 1)
+                         for f, r in izip(files, files_removed)]
+
+        read_rps = []
+        write_rps = []
+        for prev, lr, lw in izip(prevs, last_read, last_write):
+            if prev:
+                dt = ts - prev.ts
+                read_rps.append((lr - prev.last_read) / dt)
+                write_rps.append((lw - prev.last_write) / dt)
+            else:
+                read_rps.append(0)
+                write_rps.append(0)
+
+        # Disk usage should be used here instead of load average
+        max_read_rps = NodeStat.max_rps_values(read_rps, load_average)
+        max_write_rps = NodeStat.max_rps_values(write_rps, load_average)
+
+        for i, prev in enumerate(prevs):
+            if not prev:
+                # Tupical SATA HDD performance is 100 IOPS
+                # It will be used as first estimation for maximum node performance
+                max_read_rps[i] = 100
+                max_write_rps[i] = 100
+
+        stat_table.set_values([stat._slot for stat in stats], (
+            ('ts', [ts] * len(stats)),
+            ('last_read', last_read),
+            ('last_write', last_write),
+            ('total_space', total_space),
+            ('free_space', free_space),
+            ('used_space', used_space),
+            ('rel_space', rel_space),
+            ('load_average', load_average),
+            ('read_rps', read_rps),
+            ('write_rps', write_rps),
+            ('max_read_rps', max_read_rps),
+            ('max_write_rps', max_write_rps),
+            ('fragmentation', fragmentation),
+            ('files', files),
+            ('files_removed', files_removed),
+            ('fsid', counter_values('DNET_CNTR_FSID')),
+        ))
+
+    @staticmethod
+    def _check_reducible(stats):
+        if not stats or None in stats:
+            raise TypeError('Unable to reduce stats: %s' % (stats,))
+
+    @classmethod
+    def sum(cls, stats):
+        """Aggregates stats of nodes serving the same group,
+        equivalent to reduce(operator.add, stats)"""
+        cls._check_reducible(stats)
+        if len(stats) == 1:
+            return stats[0].copy()
+
+        slots = [stat._slot for stat in stats]
+        values = stat_table.values
+
+        res = cls()
+        res.ts = min(values('ts', slots))
+
+        res.total_space = sum(values('total_space', slots))
+        res.free_space = sum(values('free_space', slots))
+        res.used_space = sum(values('used_space', slots))
+        res.rel_space = min(values('rel_space', slots))
+        res.load_average = max(values('load_average', slots))
+
+        res.read_rps = sum(values('read_rps', slots))
+        res.write_rps = sum(values('write_rps', slots))
+
+        res.max_read_rps = sum(values('max_read_rps', slots))
+        res.max_write_rps = sum(values('max_write_rps', slots))
+
+        res.files = sum(values('files', slots))
+        res.files_removed = sum(values('files_removed', slots))
         res.fragmentation = float(res.files_removed) / (res.files_removed + res.files or 1)
 
         return res
 
-    def __mul__(self, other):
-        res = NodeStat()
-        res.ts = min(self.ts, other.ts)
+    @classmethod
+    def mul(cls, stats):
+        """Aggregates stats of groups forming a couple,
+        equivalent to reduce(operator.mul, stats)"""
+        cls._check_reducible(stats)
+        if len(stats) == 1:
+            return stats[0].copy()
 
-        res.total_space = min(self.total_space, other.total_space)
-        res.free_space = min(self.free_space, other.free_space)
-        res.used_space = min(self.used_space, other.used_space)
-        res.rel_space = min(self.rel_space, other.rel_space)
-        res.load_average = max(self.load_average, other.load_average)
+        slots = [stat._slot for stat in stats]
+        values = stat_table.values
 
-        res.read_rps = max(self.read_rps, other.read_rps)
-        res.write_rps = max(self.write_rps, other.write_rps)
+        res = cls()
+        res.ts = min(values('ts', slots))
 
-        res.max_read_rps = min(self.max_read_rps, other.max_read_rps)
-        res.max_write_rps = min(self.max_write_rps, other.max_write_rps)
+        res.total_space = min(values('total_space', slots))
+        res.free_space = min(values('free_space', slots))
+        res.used_space = min(values('used_space', slots))
+        res.rel_space = min(values('rel_space', slots))
+        res.load_average = max(values('load_average', slots))
+
+        res.read_rps = max(values('read_rps', slots))
+        res.write_rps = max(values('write_rps', slots))
+
+        res.max_read_rps = min(values('max_read_rps', slots))
+        res.max_write_rps = min(values('max_write_rps', slots))
 
         # files and files_removed are taken from the stat object with maximum
         # total number of keys. If total number of keys is equal,
         # the stat object with larger number of removed keys is more up-to-date
-        files_stat = max(self, other, key=lambda stat: (stat.files + stat.files_removed, stat.files_removed))
+        files_stat = max(stats, key=lambda stat: (stat.files + stat.files_removed, stat.files_removed))
         res.files = files_stat.files
         res.files_removed = files_stat.files_removed
 
         # ATTENTION: fragmentation coefficient in this case would not necessary
         # be equal to [removed keys / total keys]
-        res.fragmentation = max(self.fragmentation, other.fragmentation)
+        res.fragmentation = max(values('fragmentation', slots))
 
         return res
 
+    def __add__(self, other):
+        return NodeStat.sum([self, other])
+
+    def __mul__(self, other):
+        return NodeStat.mul([self, other])
+
     def __repr__(self):
         return ('<NodeStat object: ts=%s, write_rps=%d, max_write_rps=%d, read_rps=%d, '
                 'max_read_rps=%d, total_space=%d, free_space=%d, files_removed=%s, '
@@ -261,6 +567,9 @@ class Node(object):
         self.host.nodes.append(self)
 
         self.stat = None
+        # stat was restored from a storage state snapshot and
+        # can not be used to calculate rps
+        self.stat_restored = False
 
         self.destroyed = False
         self.read_only = False
@@ -278,8 +587,16 @@ class Node(object):
         # self.group.remove_node(self)
 
     def update_statistics(self, new_stat):
-        stat = NodeStat(new_stat, self.stat)
-        self.stat = stat
+        if self.stat is None:
+            self.stat = NodeStat(new_stat)
+        else:
+            # stat slot is reused, previous values are overwritten in place
+            self.stat.init(new_stat, None if self.stat_restored else self.stat)
+        self.stat_restored = False
+
+    def stat_expired(self):
+        return (self.stat is not None and
+                self.stat.ts < time.time() - NODE_STAT_VALID_TIME)
 
     def update_status(self):
         if self.destroyed:
@@ -290,7 +607,7 @@ class Node(object):
             self.status = Status.INIT
             self.status_text = "No statistics gathered for node %s" % (self.__str__())
 
-        elif self.stat.ts < (time.time() - 120):
+        elif self.stat_expired():
             self.status = Status.STALLED
             self.status_text = "Statistics for node %s is too old: it was gathered %d seconds ago" % (self.__str__(), int(time.time() - self.stat.ts))
 
@@ -361,14 +678,25 @@ class Group(object):
         self.group_id = group_id
         self.status = Status.INIT
         self.nodes = []
-        self.couple = None
+        self._couple = None
         self.meta = None
+        # packed meta the current meta was parsed from
+        self.raw_meta = None
         self.status_text = "Group %s is not inititalized yet" % (self.__str__())
 
         if nodes:
             for node in nodes:
                 self.add_node(node)
 
+    @property
+    def couple(self):
+        return self._couple
+
+    @couple.setter
+    def couple(self, couple):
+        self._couple = couple
+        groups.reindex(self)
+
     def add_node(self, node):
         self.nodes.append(node)
 
@@ -379,21 +707,27 @@ class Group(object):
         self.nodes.remove(node)
 
     def parse_meta(self, meta):
+        old_meta = self.meta
+
         if meta is None:
             self.meta = None
             self.status = Status.BAD
-            return
-
-        parsed = msgpack.unpackb(meta)
-        if isinstance(parsed, tuple):
-            self.meta = {'version': 1, 'couple': parsed, 'namespace': self.DEFAULT_NAMESPACE}
-        elif isinstance(parsed, dict) and parsed['version'] == 2:
-            self.meta = parsed
         else:
-            raise Exception('Unable to parse meta')
+            parsed = msgpack.unpackb(meta)
+            if isinstance(parsed, tuple):
+                self.meta = {'version': 1, 'couple': parsed, 'namespace': self.DEFAULT_NAMESPACE}
+            elif isinstance(parsed, dict) and parsed['version'] == 2:
+                self.meta = parsed
+            else:
+                raise Exception('Unable to parse meta')
+        self.raw_meta = meta
+
+        if self.couple and self.meta != old_meta:
+            # couple namespace is determined by group metas
+            self.couple.reset_namespace()
 
     def get_stat(self):
-        return reduce(lambda res, x: res + x, [node.stat for node in self.nodes])
+        return NodeStat.sum([node.stat for node in self.nodes])
 
     def update_status_recursive(self):
         if self.couple:
@@ -481,18 +815,33 @@ class Group(object):
 
 class Couple(object):
     def __init__(self, groups):
-        self.status = Status.INIT
+        self._status = Status.INIT
         self.groups = sorted(groups, key=lambda group: group.group_id)
         self.meta = None
+        # packed meta the current meta was parsed from
+        self.raw_meta = None
+        self._namespace = None
+        self._namespace_valid = False
         for group in self.groups:
             if group.couple:
                 raise Exception('Group %s is already in couple' % (repr(group)))
 
             group.couple = self
 
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        if status == self._status:
+            return
+        self._status = status
+        couples.reindex(self)
+
     def get_stat(self):
         try:
-            return reduce(lambda res, x: res * x, [group.get_stat() for group in self.groups])
+            return NodeStat.mul([group.get_stat() for group in self.groups])
         except TypeError:
             return None
 
@@ -553,11 +902,13 @@ class Couple(object):
     def parse_meta(self, meta):
         if meta is None:
             self.meta = None
+            self.raw_meta = None
             return
 
-        meta = msgpack.unpackb(meta)
-        if meta['version'] == 1:
-            self.meta = meta
+        parsed = msgpack.unpackb(meta)
+        if parsed['version'] == 1:
+            self.meta = parsed
+            self.raw_meta = meta
         else:
             raise ValueError('Unable to parse couple meta')
 
@@ -565,11 +916,13 @@ class Couple(object):
         if not self.meta:
             self.meta = self.compose_meta()
         self.meta['frozen'] = True
+        self.raw_meta = None
 
     def unfreeze(self):
         if not self.meta:
             self.meta = self.compose_meta()
         self.meta['frozen'] = False
+        self.raw_meta = None
 
     @property
     def frozen(self):
@@ -583,10 +936,12 @@ class Couple(object):
         for group in self.groups:
             group.couple = None
             group.meta = None
+            group.raw_meta = None
 
         couples.remove(self)
         self.groups = []
         self.status = Status.INIT
+        self._namespace_valid = False
 
     def compose_meta(self, frozen=False):
         meta = {'version': 1}
@@ -603,6 +958,16 @@ class Couple(object):
 
     @property
     def namespace(self):
+        if not self._namespace_valid:
+            self._namespace = self._get_namespace()
+            self._namespace_valid = True
+        return self._namespace
+
+    def reset_namespace(self):
+        self._namespace_valid = False
+        couples.reindex(self)
+
+    def _get_namespace(self):
         assert self.groups, "Couple %s has empty group list (id: %s)" % (repr(self), id(self))
         available_metas = [group.meta for group in self.groups
                            if group.meta]
@@ -671,60 +1036,180 @@ groups = Repositary(Group)
 nodes = Repositary(Node)
 couples = Repositary(Couple)
 
+couples.add_index('status', lambda couple: (couple.status,))
+couples.add_index('namespace', lambda couple: (couple.namespace,))
+groups.add_index('uncoupled', lambda group: (group.couple is None,))
 
-def stat_result_entry_to_dict(sre):
-    cnt = sre.statistics.counters
-    stat = {'group_id': sre.address.group_id,
-            'addr': '{0}:{1}'.format(sre.address.host, sre.address.port)}
-    stat.update(sre.statistics.counters)
-    return stat
+status_tracker = StatusTracker()
+
+
+def stat_result_entry(sre):
+    return (sre.address.group_id,
+            '{0}:{1}'.format(sre.address.host, sre.address.port),
+            sre.statistics.counters)
 
 
 def update_statistics(stats):
 
     if getattr(stats, 'get', None):
-        stats = [stat_result_entry_to_dict(sre) for sre in stats.get()]
+        stats = [stat_result_entry(sre) for sre in stats.get()]
+    else:
+        stats = [(stat['group_id'], stat['addr'], stat) for stat in stats]
 
-    for stat in stats:
-        logger.info("Stats: %s %s" % (str(stat['group_id']), stat['addr']))
+    updated_nodes = []
+    raw_stats = []
 
-        try:
+    for gid, addr, raw_stat in stats:
+        logger.info("Stats: %s %s" % (str(gid), addr))
 
-            gid = stat['group_id']
+        try:
 
-            if not stat['addr'] in nodes:
-                addr = stat['addr'].split(':')
-                if not addr[0] in hosts:
-                    host = hosts.add(addr[0])
-                    logger.debug('Adding host %s' % (addr[0]))
+            if not addr in nodes:
+                host_addr, port = addr.split(':')
+                if not host_addr in hosts:
+                    host = hosts.add(host_addr)
+                    logger.debug('Adding host %s' % (host_addr))
                 else:
-                    host = hosts[addr[0]]
+                    host = hosts[host_addr]
 
-                nodes.add(host, addr[1])
+                nodes.add(host, port)
 
             if not gid in groups:
                 group = groups.add(gid)
-                logger.debug('Adding group %d' % stat['group_id'])
+                logger.debug('Adding group %d' % gid)
             else:
                 group = groups[gid]
 
             logger.info('Stats for node %s' % gid)
 
-            node = nodes[stat['addr']]
+            node = nodes[addr]
 
             if not node in group.nodes:
                 group.add_node(node)
                 logger.debug('Adding node %d -> %s:%s' %
                               (gid, node.host.addr, node.port))
 
-
-            logger.info('Updating statistics for node %s' % (str(node)))
-            node.update_statistics(stat)
-            logger.info('Updating status for group %d' % gid)
-            groups[gid].update_status()
+            updated_nodes.append(node)
+            raw_stats.append(raw_stat)
+            status_tracker.mark_group(group)
 
         except Exception as e:
-            logger.error('Unable to process statictics for node %s group_id %d (%s): %s' % (stat['addr'], stat['group_id'], e, traceback.format_exc()))
+            logger.error('Unable to process statictics for node %s group_id %d (%s): %s' % (addr, gid, e, traceback.format_exc()))
+
+    logger.info('Updating statistics for %d nodes' % len(updated_nodes))
+    try:
+        node_stats = [node.stat or NodeStat() for node in updated_nodes]
+        prevs = [None if node.stat_restored else node.stat
+                 for node in updated_nodes]
+        NodeStat.init_many(node_stats, raw_stats, prevs)
+        for node, stat in izip(updated_nodes, node_stats):
+            node.stat = stat
+            node.stat_restored = False
+    except Exception as e:
+        logger.error('Unable to process statistics in batch, falling back '
+                     'to per node processing: %s\n%s' % (e, traceback.format_exc()))
+        for node, raw_stat in izip(updated_nodes, raw_stats):
+            try:
+                node.update_statistics(raw_stat)
+            except Exception as e:
+                logger.error('Unable to process statictics for node %s: %s\n%s' % (node, e, traceback.format_exc()))
+
+    # nodes that stopped reporting are not marked above,
+    # their groups are checked when statistics gets too old
+    for group in groups.keys():
+        for node in group.nodes:
+            if node.status != Status.STALLED and node.stat_expired():
+                status_tracker.mark_group(group)
+                break
+
+    status_tracker.update_statuses()
+
+
+STORAGE_STATE_VERSION = 1
+
+
+def dump_state():
+    """Returns storage model snapshot suitable for msgpack serialization."""
+    state = {'version': STORAGE_STATE_VERSION,
+             'ts': time.time(),
+             'nodes': [],
+             'groups': [],
+             'couples': []}
+
+    for node in nodes.keys():
+        if node.destroyed:
+            continue
+        state['nodes'].append((str(node), node.read_only,
+                               node.stat and stat_table.row(node.stat._slot)))
+
+    for group in groups.keys():
+        state['groups'].append((group.group_id,
+                                [str(node) for node in group.nodes if not node.destroyed],
+                                group.raw_meta))
+
+    for couple in couples.keys():
+        state['couples'].append(([group.group_id for group in couple.groups],
+                                 couple.raw_meta))
+
+    return state
+
+
+def load_state(state):
+    """Restores storage model from a dump_state snapshot.
+
+    Only missing entities are created, already known ones are left intact.
+    Restored node stats are shifted by the snapshot age, so node statuses
+    are the same as they were at the dump time: nodes that were stalled
+    stay stalled, the others are stalled if they do not report in time."""
+    if state.get('version') != STORAGE_STATE_VERSION:
+        raise ValueError('Unsupported storage state version: %s' %
+                         state.get('version'))
+
+    ts_shift = max(time.time() - state['ts'], 0)
+
+    for addr, read_only, stat_row in state['nodes']:
+        if addr in nodes:
+            continue
+        host_addr, port = addr.split(':')
+        if not host_addr in hosts:
+            host = hosts.add(host_addr)
+        else:
+            host = hosts[host_addr]
+        node = nodes.add(host, port)
+        node.read_only = read_only
+        if stat_row:
+            node.stat = NodeStat()
+            stat_table.set_row(node.stat._slot, stat_row)
+            node.stat.ts += ts_shift
+            node.stat_restored = True
+
+    for group_id, node_addrs, raw_meta in state['groups']:
+        if group_id in groups:
+            continue
+        group = groups.add(group_id)
+        for addr in node_addrs:
+            if addr in nodes:
+                group.add_node(nodes[addr])
+        try:
+            group.parse_meta(raw_meta)
+        except Exception as e:
+            logger.error('Unable to restore meta for group %d: %s' % (group_id, e))
+        status_tracker.mark_group(group)
+
+    for group_ids, raw_meta in state['couples']:
+        couple_str = ':'.join(str(gid) for gid in sorted(group_ids))
+        if couple_str in couples:
+            continue
+        if not all(gid in groups for gid in group_ids):
+            continue
+        couple = couples.add([groups[gid] for gid in group_ids])
+        try:
+            couple.parse_meta(raw_meta)
+        except Exception as e:
+            logger.error('Unable to restore meta for couple %s: %s' % (couple_str, e))
+        status_tracker.mark_couple(couple)
+
+    status_tracker.update_statuses()
 
 
 '''
@@ -1,17 +1,26 @@
 # -*- coding: utf-8 -*-
-import threading
+from collections import deque
+import errno
+import fcntl
 import heapq
+import os
+import Queue
+import select
+import threading
 import time
 
+from config import config
+
 
 class Task:
 
-    def __init__(self, task_id, function, args, kwargs):
+    def __init__(self, task_id, function, args, kwargs, concurrency_key=None):
         self.__id = task_id
         self.__function = function
         self.__args = args
         self.__kwargs = kwargs
         self.__done = False
+        self.__concurrency_key = concurrency_key or task_id
 
     def execute(self):
         try:
@@ -25,10 +34,19 @@ class Task:
     def id(self):
         return self.__id
 
+    def concurrency_key(self):
+        return self.__concurrency_key
+
 
 class TimedQueue:
+    """Executes tasks at the scheduled time.
 
-    def __init__(self):
+    By default tasks are executed one by one in the queue loop thread.
+    When workers number is set, tasks are executed by the worker pool,
+    tasks with the same concurrency key (task id by default)
+    are never executed simultaneously."""
+
+    def __init__(self, workers=0):
         self.__shutting_down = False
         self.__shutdown_lock = threading.Lock()
         self.__heap = []
@@ -38,62 +56,213 @@ class TimedQueue:
         self.__loop_thread = threading.Thread(target=TimedQueue.loop, args=(self,))
         self.__loop_thread.setDaemon(True)
 
+        self.__ready = Queue.Queue()
+        self.__running_keys = set()
+        self.__pending = {}
+        self.__workers = []
+        for i in xrange(workers):
+            worker = threading.Thread(target=TimedQueue.worker, args=(self,))
+            worker.setDaemon(True)
+            self.__workers.append(worker)
+
+        # loop thread sleeps on the read end of the pipe until the next
+        # task deadline, any write to the pipe wakes it up immediately
+        self.__wakeup_r, self.__wakeup_w = os.pipe()
+        for fd in (self.__wakeup_r, self.__wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
     def start(self):
         self.__loop_thread.start()
+        for worker in self.__workers:
+            worker.start()
 
     def __del__(self):
         if not self._is_shutting_down():
             self.shutdown()
+        os.close(self.__wakeup_r)
+        os.close(self.__wakeup_w)
 
     def _is_shutting_down(self):
         with self.__shutdown_lock:
             shutting_down = self.__shutting_down
         return shutting_down
 
+    def _wakeup(self):
+        try:
+            os.write(self.__wakeup_w, '\0')
+        except OSError as e:
+            # pipe is full, loop thread will wake up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _sleep(self, timeout):
+        select.select([self.__wakeup_r], [], [], timeout)
+        try:
+            while os.read(self.__wakeup_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
     def loop(self):
         while not self._is_shutting_down():
             task = None
+            timeout = None
             with self.__heap_lock:
                 if self.__hurry:
                     task = self.__hurry.pop()
-                elif self.__heap and time.time() >= self.__heap[0][0]:
-                    task = heapq.heappop(self.__heap)[1]
+                elif self.__heap:
+                    timeout = self.__heap[0][0] - time.time()
+                    if timeout <= 0:
+                        task = heapq.heappop(self.__heap)[1]
             if task is None:
-                time.sleep(1)
+                # sleeping until the next task deadline or until
+                # the queue is changed
+                self._sleep(timeout)
             else:
                 with self.__heap_lock:
                     id_ = task.id()
                     if id_ in self.__task_by_id:
                         del self.__task_by_id[id_]
                 if not task.done():
-                    try:
-                        task.execute()
-                    except:
-                        # Task should handle its exceptions. If it doesn't, will lose it here.
-                        # The loop should not stop because of it.
-                        pass
+                    self._dispatch(task)
+
+    def _dispatch(self, task):
+        if not self.__workers:
+            self._execute(task)
+            return
+
+        with self.__heap_lock:
+            key = task.concurrency_key()
+            if key in self.__running_keys:
+                # task will be passed to workers when
+                # the running task with the same key is finished
+                self.__pending.setdefault(key, deque()).append(task)
+                return
+            self.__running_keys.add(key)
+
+        self.__ready.put(task)
+
+    def worker(self):
+        while True:
+            task = self.__ready.get()
+            if task is None:
+                break
+
+            self._execute(task)
+
+            with self.__heap_lock:
+                key = task.concurrency_key()
+                pending = self.__pending.get(key)
+                if pending:
+                    next_task = pending.popleft()
+                    if not pending:
+                        del self.__pending[key]
+                else:
+                    next_task = None
+                    self.__running_keys.discard(key)
+
+            if next_task:
+                self.__ready.put(next_task)
+
+    def _execute(self, task):
+        if task.done():
+            return
+        try:
+            task.execute()
+        except:
+            # Task should handle its exceptions. If it doesn't, will lose it here.
+            # The loop should not stop because of it.
+            pass
 
     def add_task_in(self, task_id, secs, function, *args, **kwargs):
         self.add_task_at(task_id, time.time() + secs, function, *args, **kwargs)
 
     def add_task_at(self, task_id, at, function, *args, **kwargs):
+        self._add_task(task_id, at, None, function, args, kwargs)
+
+    def _add_task(self, task_id, at, concurrency_key, function, args, kwargs):
         if self._is_shutting_down():
             return
         with self.__heap_lock:
             if task_id in self.__task_by_id:
                 raise Exception("Task with ID %s already exists" % task_id)
-            task = Task(task_id, function, args, kwargs)
+            task = Task(task_id, function, args, kwargs,
+                        concurrency_key=concurrency_key)
             heapq.heappush(self.__heap, (at, task))
             self.__task_by_id[task_id] = task
+        self._wakeup()
 
     def hurry(self, task_id):
         with self.__heap_lock:
             if task_id in self.__task_by_id:
                 self.__hurry.append(self.__task_by_id[task_id])
-                return True
-        return False
+                hurried = True
+            else:
+                hurried = False
+        if hurried:
+            self._wakeup()
+        return hurried
 
     def shutdown(self):
         with self.__shutdown_lock:
             self.__shutting_down = True
+        self._wakeup()
         self.__loop_thread.join()
+        for worker in self.__workers:
+            self.__ready.put(None)
+        for worker in self.__workers:
+            worker.join()
+
+    def register(self, name, exclusive=False):
+        """Returns task group for a subsystem using this queue"""
+        return TaskGroup(self, name, exclusive=exclusive)
+
+
+class TaskGroup(object):
+    """Subsystem tasks in a shared queue.
+
+    Tasks of an exclusive group are never executed simultaneously.
+    Shutting down the group drops its tasks without stopping the queue."""
+
+    def __init__(self, queue, name, exclusive=False):
+        self.queue = queue
+        self.name = name
+        self.concurrency_key = exclusive and name or None
+        self.__shutting_down = False
+
+    def add_task_in(self, task_id, secs, function, *args, **kwargs):
+        self.add_task_at(task_id, time.time() + secs, function, *args, **kwargs)
+
+    def add_task_at(self, task_id, at, function, *args, **kwargs):
+        if self.__shutting_down:
+            return
+        self.queue._add_task(task_id, at, self.concurrency_key,
+                             self._run, (function,) + args, kwargs)
+
+    def _run(self, function, *args, **kwargs):
+        if self.__shutting_down:
+            return
+        function(*args, **kwargs)
+
+    def hurry(self, task_id):
+        return self.queue.hurry(task_id)
+
+    def shutdown(self):
+        self.__shutting_down = True
+
+
+_shared_queue = None
+_shared_queue_lock = threading.Lock()
+
+
+def shared_queue():
+    """Returns the queue shared by mastermind subsystems"""
+    global _shared_queue
+    with _shared_queue_lock:
+        if _shared_queue is None:
+            _shared_queue = TimedQueue(
+                workers=config.get('timed_queue_workers', 4))
+            _shared_queue.start()
+    return _shared_queue